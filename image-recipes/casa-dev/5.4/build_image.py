@@ -2,7 +2,9 @@
 #
 # This file is used for building the image for Singularity and VirtualBox.
 
+import json
 import os.path
+import shlex
 
 from casa_distro.image_builder import ImageBuilder
 
@@ -10,87 +12,98 @@ from casa_distro.image_builder import ImageBuilder
 builder = ImageBuilder('casa-run', base='casa-run-5.4.{extension}')
 
 
-BUILD_FILES = [
-    'install_apt_dev_dependencies.sh',
+APT_BUILD_FILE = 'install_apt_dev_dependencies.sh'
+"""Apt installer script, staged and run separately from the other build
+files so that this slow step only depends on its own script in builders
+with a layer cache."""
+
+BUILD_FILES = (
     'install_pip_dev_dependencies.sh',
     'install_other_dev_dependencies.sh',
     'install_casa_dev_components.sh',
-]
-"""List of files that are copied into /build and removed when done."""
+)
+"""Files that are copied into /build and removed when done."""
 
 
 @builder.step
-def copy_build_files(base_dir, builder):
-    """Copy files that are necessary for building the image."""
-    for f in BUILD_FILES:
-        # /build is used instead of /tmp here because /tmp can be bind-mounted
-        # during build on Singularity (and the copied files are hidden by this
-        # mount).
-        builder.copy_root(os.path.realpath(os.path.join(base_dir, f)),
-                          '/build')
-    builder.run_root('chmod +x /build/*.sh')
-
-    builder.copy_user(os.path.join(base_dir, 'dev-environment.sh'),
-                      '/casa')
-    builder.run_user('chmod a+rx /casa/dev-environment.sh')
-    builder.run_user('echo "{\\"image_id\\": \\"%s\\", '
-                     '\\"image_version\\": \\"%s\\"}"'
-                     ' > /casa/image_id' % (builder.image_id,
-                                            builder.image_version))
-
-    builder.copy_root(os.path.realpath(os.path.join(base_dir, 'svn')),
-                      '/usr/local/bin')
-    builder.copy_root(os.path.realpath(os.path.join(base_dir,
-                                                    'askpass-bioproj.sh')),
-                      '/usr/local/bin')
-
-
-@builder.step
-def apt_dev_dependencies(base_dir, builder):
-    """Run install_apt_dev_dependencies.sh."""
-    builder.run_root('/build/install_apt_dev_dependencies.sh')
+def copy_stable_files(base_dir, builder):
+    """Copy files that rarely change between image builds.
 
+    These copies come first so that builders with a layer cache (e.g.
+    Docker) can reuse them when only the installer scripts change.
+    """
+    # Resolve the base directory once, each realpath call below then only
+    # has to resolve the final file (askpass-bioproj.sh is a symlink).
+    real_base = os.path.realpath(base_dir)
+    # mode= gives install(1) semantics: the copied binaries are usable
+    # whatever the permissions of the source checkout.
+    builder.copy_root_many(
+        [os.path.realpath(os.path.join(real_base, 'svn')),
+         os.path.realpath(os.path.join(real_base, 'askpass-bioproj.sh'))],
+        '/usr/local/bin', mode=0o755)
+    builder.copy_root(os.path.join(real_base, 'gitignore'), '/etc')
 
-@builder.step
-def pip_dev_dependencies(base_dir, builder):
-    """Run install_pip_dev_dependencies.sh."""
-    builder.run_root('/build/install_pip_dev_dependencies.sh')
+    builder.copy_user(os.path.join(base_dir, 'dev-environment.sh'),
+                      '/casa', mode=0o755)
 
 
 @builder.step
-def other_dev_dependencies(base_dir, builder):
-    """Run install_other_dev_dependencies.sh."""
-    builder.run_root('/build/install_other_dev_dependencies.sh')
+def copy_apt_installer(base_dir, builder):
+    """Copy the apt installer script into the image."""
+    # /build is used instead of /tmp here because /tmp can be bind-mounted
+    # during build on Singularity (and the copied files are hidden by this
+    # mount).
+    builder.copy_root(
+        os.path.join(os.path.realpath(base_dir), APT_BUILD_FILE),
+        '/build', mode=0o755)
 
 
 @builder.step
-def fix_wsl2(base_dir, builder):
-    """Fix image to be compatible with Windows/WSL2.
+def apt_dev_dependencies(base_dir, builder):
+    """Run install_apt_dev_dependencies.sh and fix the image for WSL2.
 
-    After apt_dev_dependencies, /run/shm is a symlink to /dev/shm
+    After installing the apt packages, /run/shm is a symlink to /dev/shm.
     But, on Winows/WSL2, /dev/shm is a symlink to /run/shm. Therefore
-    The /run/shm is removed from the image and will be mounted by
-    casa_distro according to the host system.
+    /run/shm is removed from the image and will be mounted by casa_distro
+    according to the host system. The fix is chained to the apt run to
+    avoid a dedicated command/layer for it.
     """
-    builder.run_root('if [ -L /run/shm ]; then rm /run/shm; fi')
+    builder.run_root('/build/' + APT_BUILD_FILE
+                     + ' && if [ -L /run/shm ]; then rm /run/shm; fi')
 
 
 @builder.step
-def install_casa_distro(base_dir, builder):
-    """Install casa_distro."""
-    builder.install_casa_distro('/casa/casa-distro')
+def copy_build_files(base_dir, builder):
+    """Copy the remaining files that are necessary for building the image."""
+    real_base = os.path.realpath(base_dir)
+    builder.copy_root_many(
+        [os.path.join(real_base, f) for f in BUILD_FILES],
+        '/build', mode=0o755)
 
+    # The image identifier changes on every build, keep it out of the
+    # cacheable steps above.
+    image_id_json = json.dumps({'image_id': builder.image_id,
+                                'image_version': builder.image_version})
+    builder.run_user('echo %s > /casa/image_id'
+                     % shlex.quote(image_id_json))
 
-@builder.step
-def casa_dev_components(base_dir, builder):
-    """Install casa components for development."""
-    builder.run_root('/build/install_casa_dev_components.sh')
 
-    builder.copy_root(os.path.join(base_dir, 'gitignore'), '/etc')
-    builder.run_root('git config --system core.excludesfile /etc/gitignore')
+@builder.step
+def install_all_dev(base_dir, builder):
+    """Run the remaining dev installer scripts and clean up build files."""
+    # Chaining the scripts with && produces a single command (hence a
+    # single layer/exec) instead of one per script. The gitignore
+    # configuration and /build cleanup are chained at the end for the
+    # same reason. Note that git config --system must run after the
+    # copied /etc/gitconfig settings of install_casa_dev_components.sh,
+    # it appends to the same file.
+    builder.run_root(
+        ' && '.join('/build/' + f for f in BUILD_FILES)
+        + ' && git config --system core.excludesfile /etc/gitignore'
+        + ' && rm -rf /build')
 
 
 @builder.step
-def cleanup(base_dir, builder):
-    """Clean up build files."""
-    builder.run_root('rm -rf /build')
+def install_casa_distro(base_dir, builder):
+    """Install casa_distro."""
+    builder.install_casa_distro('/casa/casa-distro')
@@ -2,7 +2,9 @@
 #
 # This file is used for building the image for Singularity and VirtualBox.
 
+import json
 import os.path
+import shlex
 
 from casa_distro.image_builder import ImageBuilder
 
@@ -10,7 +12,7 @@ from casa_distro.image_builder import ImageBuilder
 builder = ImageBuilder('casa-run', base='casa-system-ubuntu-22.04.{extension}')
 
 
-BUILD_FILES = [
+BUILD_FILES = (
     'install_apt_dependencies.sh',
     'build_dependencies.sh',
     'neurodebian.sources.list',
@@ -20,8 +22,8 @@ BUILD_FILES = [
     'install_compiled_dependencies.sh',
     'cleanup_build_dependencies.sh',
     'build_sip_pyqt.sh',
-]
-"""List of files that are copied into /build and removed when done."""
+)
+"""Files that are copied into /build and removed when done."""
 
 
 @builder.step
@@ -45,26 +47,27 @@ def mount_points(base_dir, builder):
 def copy_build_files(base_dir, builder):
     """Copy files that are necessary for building the image."""
     builder.run_root('if [ ! -e /build ]; then mkdir /build; fi')
-    for f in BUILD_FILES:
-        # /build is used instead of /tmp here because /tmp can be bind-mounted
-        # during build on Singularity (and the copied files are hidden by this
-        # mount).
-        builder.copy_root(os.path.join(base_dir, f), '/build')
-    builder.run_root('chmod +x /build/*.sh')
+    # /build is used instead of /tmp here because /tmp can be bind-mounted
+    # during build on Singularity (and the copied files are hidden by this
+    # mount).
+    builder.copy_root_many([os.path.join(base_dir, f) for f in BUILD_FILES
+                            if f.endswith('.sh')],
+                           '/build', mode=0o755)
+    builder.copy_root_many([os.path.join(base_dir, f) for f in BUILD_FILES
+                            if not f.endswith('.sh')],
+                           '/build')
 
     builder.copy_user(os.path.join(base_dir, 'environment.sh'),
-                      '/casa')
-    builder.run_user('chmod a+rx /casa/environment.sh')
-    builder.run_user('echo "{\\"image_id\\": \\"%s\\", '
-                     '\\"image_version\\": \\"%s\\"}"'
-                     ' > /casa/image_id' % (builder.image_id,
-                                            builder.image_version))
+                      '/casa', mode=0o755)
+    image_id_json = json.dumps({'image_id': builder.image_id,
+                                'image_version': builder.image_version})
+    builder.run_user('echo %s > /casa/image_id'
+                     % shlex.quote(image_id_json))
 
     builder.copy_user(os.path.join(base_dir, 'bashrc'),
                       '/casa')
     builder.copy_root(os.path.join(base_dir, 'entrypoint'),
-                      '/usr/local/bin/')
-    builder.run_root('chmod a+rx /usr/local/bin/entrypoint')
+                      '/usr/local/bin', mode=0o755)
 
 
 @builder.step
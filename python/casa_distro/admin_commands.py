@@ -2,16 +2,20 @@
 from __future__ import absolute_import, division, print_function
 
 import datetime
+import fnmatch
+import functools
 import glob
+import hashlib
 import json
 import os
 import os.path as osp
 from pprint import pprint
-import re
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 import zipfile
@@ -29,18 +33,70 @@ from casa_distro.log import verbose_file, boolean_value
 import casa_distro.singularity
 import casa_distro.vbox
 import casa_distro.docker
-from casa_distro.hash import file_hash
+from casa_distro.hash import file_size_and_hash
 from .image_builder import get_image_builder, LocalInstaller
 
 
-_true_str = re.compile('^(?:yes|true|y|1)$', re.I)
-_false_str = re.compile('^(?:no|false|n|0|none)$', re.I)
+_true_str = frozenset(('yes', 'true', 'y', '1'))
+_false_str = frozenset(('no', 'false', 'n', '0', 'none'))
+
+
+@functools.lru_cache(maxsize=32)
+def _dir_entries(directory):
+    '''
+    Cached listing of a directory, used by the image glob fallbacks
+    below. Call ``_dir_entries.cache_clear()`` after writing new files
+    into one of the listed directories.
+    '''
+    try:
+        return tuple(os.listdir(directory))
+    except OSError:
+        return ()
+
+
+def _glob_cached(pattern):
+    '''
+    Equivalent of glob.glob(pattern) for patterns whose directory part
+    contains no wildcard, reusing the cached directory listing instead
+    of rescanning the directory on every call.
+    '''
+    directory, basename = osp.split(pattern)
+    if glob.has_magic(directory):
+        return glob.glob(pattern)
+    return [osp.join(directory, name)
+            for name in _dir_entries(directory or os.curdir)
+            # like glob, a leading dot is only matched explicitly
+            if (not name.startswith('.') or basename.startswith('.'))
+            and fnmatch.fnmatchcase(name, basename)]
+
+
+def _install_manifest(install_dir):
+    '''
+    Fast digest of an install tree: relative paths, sizes and mtimes
+    (not file contents). Used to decide whether the zip archive of a
+    user image needs to be rebuilt.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    prefix_len = len(install_dir) + 1
+    stack = [install_dir]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in sorted(it, key=lambda e: e.path):
+                digest.update(entry.path[prefix_len:].encode())
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    st = entry.stat(follow_symlinks=False)
+                    digest.update(struct.pack('<qq', st.st_size,
+                                              st.st_mtime_ns))
+    return digest.hexdigest()
 
 
 def str_to_bool(string):
-    if _false_str.match(string):
+    value = string.lower()
+    if value in _false_str:
         return False
-    if _true_str.match(string):
+    if value in _true_str:
         return True
     raise ValueError('Invalid value for boolean: ' + repr(string))
 
@@ -49,7 +105,9 @@ def str_to_bool(string):
 def singularity_deb(dockerhub='ubuntu:20.04',
                     output_dir=osp.abspath(os.curdir),
                     version='3.8.3',
-                    go_version='1.17'):
+                    go_version='1.17',
+                    jobs='0',
+                    cachedir=None):
     """Create a Debian package to install Singularity.
     Perform the whole installation process from a rw system and Singularity
     source. Then put the result in a ``*.deb`` file.
@@ -59,7 +117,9 @@ def singularity_deb(dockerhub='ubuntu:20.04',
     dockerhub:
         default={dockerhub_default}
 
-        Name of the base image system to pull from DockerHub.
+        Name of the base image system to pull from DockerHub. Several
+        systems may be given, separated by commas; their packages are
+        then built concurrently (the builds are independent).
     output_dir:
         default={output_dir_default}
 
@@ -69,122 +129,101 @@ def singularity_deb(dockerhub='ubuntu:20.04',
 
         Version of Singularity to use. This must be a valid release version.
         Go language is not included in the final package.
+    jobs:
+        default={jobs_default}
+
+        Number of packages to build concurrently when several systems are
+        given. 0 means one job per system.
+    cachedir:
+        default={cachedir_default}
+
+        If set, use this directory as the Singularity/Apptainer cache
+        directory instead of disabling the cache, so that rebuilding a
+        package for the same system skips the DockerHub pull.
     """
+    dockerhubs = [d.strip() for d in dockerhub.split(',') if d.strip()]
+    if not dockerhubs:
+        raise ValueError('No DockerHub system given')
+    if len(dockerhubs) > 1:
+        jobs = int(jobs) or len(dockerhubs)
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_singularity_deb_one, d, output_dir,
+                                   version, go_version, cachedir)
+                       for d in dockerhubs]
+            # collect all results so that every build failure is raised,
+            # not only the first one
+            for future in futures:
+                future.result()
+    else:
+        _singularity_deb_one(dockerhubs[0], output_dir, version, go_version,
+                             cachedir)
+
+
+def _build_tmp_dir():
+    '''
+    Base directory for package build trees: $CASA_BUILD_TMP if set,
+    otherwise /dev/shm when it exists with at least 8 GiB free (the
+    build is dominated by small-file I/O, which is much faster on
+    tmpfs), otherwise the default temporary directory.
+    '''
+    build_tmp = os.environ.get('CASA_BUILD_TMP')
+    if build_tmp:
+        return build_tmp
+    if osp.isdir('/dev/shm'):
+        try:
+            if shutil.disk_usage('/dev/shm').free >= 8 * 1024 ** 3:
+                return '/dev/shm'
+        except OSError:
+            pass
+    return None
+
 
-    tmp = tempfile.mkdtemp(prefix='singularity-container-deb-')
+def _singularity_deb_one(dockerhub, output_dir, version, go_version,
+                         cachedir=None):
+    """Build the Singularity Debian package for a single system."""
+    tmp = tempfile.mkdtemp(prefix='singularity-container-deb-',
+                           dir=_build_tmp_dir())
     singularity_image = 'singularity_image'
     try:
-        build_sh = osp.join(tmp, 'build.sh')
-        open(build_sh, 'w').write('''#!/bin/sh
-set -xe
-umask 0022  # avoid Lintian warning non-standard-file-perm
-OS=linux
-ARCH=amd64
-DEB_HOST_MULTIARCH=x86_64-linux-gnu
-ID=
-VERSION_ID=
-. /etc/os-release  # sets the ID and VERSION_ID variables
-DISTRIB=${ID}-${VERSION_ID}
-package_version=${SINGULARITY_VERSION}~${DISTRIB}
-#Installation des packages requis
-apt-get update -y
-DEBIAN_FRONTEND=noninteractive apt-get install -y build-essential uuid-dev \
-    libgpgme-dev squashfs-tools libseccomp-dev wget pkg-config git \
-    cryptsetup-bin libssl-dev
-# Download and install GO
-rm -rf /usr/local/go
-wget -O $TMP/go${GO_VERSION}.${OS}-${ARCH}.tar.gz \
-    https://dl.google.com/go/go${GO_VERSION}.${OS}-${ARCH}.tar.gz
-tar -C /usr/local -xzf $TMP/go${GO_VERSION}.${OS}-${ARCH}.tar.gz
-rm -f $TMP/go${GO_VERSION}.${OS}-${ARCH}.tar.gz
-export GOPATH=${HOME}/go
-export GOROOT=/usr/local/go
-export PATH=$GOROOT/bin:$PATH:${GOPATH}/bin
-# Download the requested Singularity release
-wget -O $TMP/singularity-ce-${SINGULARITY_VERSION}.tar.gz \
-    https://github.com/sylabs/singularity/releases/download/v${SINGULARITY_VERSION}/singularity-ce-${SINGULARITY_VERSION}.tar.gz
-mkdir -p ${GOPATH}/src/github.com/sylabs
-tar -C ${GOPATH}/src/github.com/sylabs -zxf \
-    $TMP/singularity-ce-${SINGULARITY_VERSION}.tar.gz
-# Build and install Singularity into DESTDIR
-export DESTDIR=$TMP/singularity-ce_${package_version}_amd64
-rm -rf ${DESTDIR}
-cd ${GOPATH}/src/github.com/sylabs/singularity-ce-${SINGULARITY_VERSION}
-./mconfig \
-    -P release-stripped \
-    --prefix=/usr \
-    --sysconfdir=/etc \
-    --libexecdir=/usr/lib/${DEB_HOST_MULTIARCH} \
-    --localstatedir=/var/lib
-make -C ./builddir
-make -C ./builddir install DESTDIR=${DESTDIR}
-mkdir -p ${DESTDIR}/DEBIAN
-cat <<EOF > ${DESTDIR}/DEBIAN/control
-Package: singularity-ce
-Version: ${package_version}
-Maintainer: BrainVISA release team <admin@brainvisa.info>
-Architecture: ${ARCH}
-Section: admin
-Priority: optional
-Depends: squashfs-tools, ca-certificates, cryptsetup-bin, libc6, libseccomp2
-Conflicts: singularity-container
-Replaces: singularity-container (<< ${SINGULARITY_VERSION})
-Recommends: e2fsprogs
-Homepage: https://www.sylabs.io/
-Description: container platform focused on supporting "Mobility of Compute"
- Mobility of Compute encapsulates the development to compute model
- where developers can work in an environment of their choosing and
- creation and when the developer needs additional compute resources,
- this environment can easily be copied and executed on other platforms.
- Additionally as the primary use case for Singularity is targeted
- towards computational portability, many of the barriers to entry of
- other container solutions do not apply to Singularity making it an
- ideal solution for users (both computational and non-computational)
- and HPC centers.
-EOF
-# Fix Lintian warning setuid-binary
-mkdir -p ${DESTDIR}/usr/share/lintian/overrides
-cat <<EOF > ${DESTDIR}/usr/share/lintian/overrides/singularity-ce
-# Singularity requires root suid for operation:
-setuid-binary usr/lib/*/singularity/bin/*-suid 4755 root/root
-EOF
-# Fix Lintian warning package-installs-into-obsolete-dir
-mkdir -p ${DESTDIR}/usr/share/bash-completion/completions
-mv ${DESTDIR}/etc/bash_completion.d/* \
-    ${DESTDIR}/usr/share/bash-completion/completions/
-rmdir ${DESTDIR}/etc/bash_completion.d/
-# Fix Lintian warning file-in-etc-not-marked-as-conffile
-find ${DESTDIR}/etc ! -type d -print \
-    | sed -e "s!^${DESTDIR%/}!!" \
-    > ${DESTDIR}/DEBIAN/conffiles
-dpkg-deb --build ${DESTDIR} "$TMP"
-''')
-
-        subprocess.check_call(['singularity', 'build',
-                               '--fakeroot',
-                               '--disable-cache',
-                               '--sandbox', singularity_image,
-                               'docker://{}'.format(dockerhub)],
-                              cwd=tmp)
+        build_sh = osp.join(casa_distro.share_directory,
+                            'scripts', 'build_singularity_deb.sh')
+
+        build_command = ['singularity', 'build', '--fakeroot']
+        if not cachedir:
+            build_command.append('--disable-cache')
+        build_command += ['--sandbox', singularity_image,
+                          'docker://{}'.format(dockerhub)]
+        subprocess.check_call(
+            build_command, cwd=tmp,
+            env=casa_distro.singularity._singularity_build_env(cachedir))
+        # the build script is shipped as package data and bind-mounted
+        # read-only instead of being rewritten per build
         subprocess.check_call(['singularity', 'run',
                                '--writable',
                                '--fakeroot',
                                '--home', tmp,
+                               '--bind', '{}:/build.sh:ro'.format(build_sh),
                                '--env', 'TMP={}'.format(tmp),
                                '--env', 'GO_VERSION={}'.format(go_version),
                                '--env',
                                'SINGULARITY_VERSION={}'.format(version),
                                singularity_image,
-                               'sh', build_sh],
+                               'sh', '/build.sh'],
                               cwd=tmp)
         deb = osp.basename(glob.glob(osp.join(tmp, '*.deb'))[0])
         shutil.move(osp.join(tmp, deb), osp.join(output_dir, deb))
     finally:
-        # cleanup with singularity to take into account files
-        # created with --fakeroot not belonging to current user
-        subprocess.check_call(['singularity', 'exec', '--disable-cache',
-                               '--fakeroot', 'library://alpine', 'rm',
-                               '-Rf', tmp])
+        # Try a plain removal first: it works whenever the build did not
+        # leave files mapped to other (sub)uids, and avoids starting a
+        # container just to run rm.
+        shutil.rmtree(tmp, ignore_errors=True)
+        if osp.exists(tmp):
+            # cleanup with singularity to take into account files
+            # created with --fakeroot not belonging to current user
+            subprocess.check_call(['singularity', 'exec', '--disable-cache',
+                                   '--fakeroot', 'library://alpine', 'rm',
+                                   '-Rf', tmp])
 
 
 @command
@@ -283,6 +322,14 @@ def create_base_image(type,
         images (this is the recommended wby). Otherwise, "sudo singularity"
         must be used so singularity has root access on the host.
 
+    cachedir (allowed only if container_type=singularity)
+        default=None
+
+        If set, use this directory as the Singularity/Apptainer cache
+        directory (SINGULARITY_CACHEDIR) instead of disabling the cache.
+        Useful on CI runners where the cache directory is persisted
+        between builds, so that unchanged layers are reused.
+
     memory (allowed only if container_type=vbox)
         default=8192
 
@@ -304,6 +351,13 @@ def create_base_image(type,
 
         For vbox container type only. If value is "yes", "true" or "1", display
         VirtualBox window.
+
+    jobs (allowed only if container_type=vbox)
+        default=1
+
+        For vbox container type only. Number of concurrent file uploads
+        into the VM. Uploading many small files is latency-bound, so a
+        few parallel jobs can hide the per-file round-trip.
     """  # noqa: E501
     verbose = verbose_file(verbose)
 
@@ -348,7 +402,7 @@ def create_base_image(type,
         if verbose:
             print('Looking for base in', base_pattern,
                   file=verbose)
-        bases = glob.glob(base_pattern)
+        bases = _glob_cached(base_pattern)
         if len(bases) == 0:
             # Raise appropriate error for non existing file
             open(base)
@@ -360,7 +414,8 @@ def create_base_image(type,
     base = os.path.join(default_base_directory, base)  # make path absolute
 
     if osp.exists(base + '.json'):
-        base_metadata = json.load(open(base + '.json'))
+        with open(base + '.json') as f:
+            base_metadata = json.load(f)
     else:
         base_metadata = {}
     system = base_metadata.get('system')
@@ -401,8 +456,6 @@ def create_base_image(type,
             print('using', image_builder.build_file, file=verbose)
         print('metadata = ', end='', file=verbose)
         pprint(metadata, stream=verbose, indent=4)
-    json.dump(metadata, open(metadata_output, 'w'),
-              indent=4, separators=(',', ': '))
 
     if container_type == 'vbox':
         module = casa_distro.vbox
@@ -421,11 +474,12 @@ def create_base_image(type,
     if msg:
         print(msg)
     elif osp.isfile(output):
-        metadata['size'] = os.stat(output).st_size
-        metadata['md5'] = file_hash(output)
+        metadata['size'], metadata['md5'] = file_size_and_hash(output)
         metadata['image_id'] = image_id
-        json.dump(metadata, open(metadata_output, 'w'),
-                  indent=4, separators=(',', ': '))
+    # single metadata write, once size/hash are known (it used to be
+    # fully written a first time before the build)
+    with open(metadata_output, 'w') as f:
+        json.dump(metadata, f, indent=4, separators=(',', ': '))
 
 
 def create_numbered_file(url, filename, metadata):
@@ -610,7 +664,7 @@ def publish_base_image(type=None,
     image = image.format(type=type,
                          extension=extension)
     if not osp.exists(image):
-        images = glob.glob(osp.expandvars(osp.expanduser(image)))
+        images = _glob_cached(osp.expandvars(osp.expanduser(image)))
         if len(images) == 0:
             # Raise appropriate error for non existing file
             open(image)
@@ -625,9 +679,9 @@ def publish_base_image(type=None,
 
     # Add image file md5 hash to JSON metadata file
     metadata_file = image + '.json'
-    metadata = json.load(open(metadata_file))
-    metadata['size'] = os.stat(image).st_size
-    metadata['md5'] = file_hash(image)
+    with open(metadata_file) as f:
+        metadata = json.load(f)
+    metadata['size'], metadata['md5'] = file_size_and_hash(image)
 
     url, remote_path = publish_url.split(':', 1)
     remote_metadata_file = osp.join(remote_path, osp.basename(metadata_file))
@@ -640,13 +694,16 @@ def publish_base_image(type=None,
         return
     metadata['build_number'] = num
 
-    json.dump(metadata, open(metadata_file, 'w'),
-              indent=4, separators=(',', ': '))
+    with open(metadata_file, 'w') as f:
+        json.dump(metadata, f, indent=4, separators=(',', ': '))
 
     final_imagefile = osp.splitext(final_metafile)[0]
     print('final_imagefile:', repr(final_imagefile))
     image_path, image_base = osp.split(image)
-    subprocess.check_call(['rsync', '-P', '--progress', '--chmod=a+r',
+    # images are opaque compressed blobs: --whole-file skips the rsync
+    # delta algorithm, whose checksumming dominates on fast links
+    subprocess.check_call(['rsync', '--partial', '--info=progress2',
+                           '--whole-file', '--chmod=a+r',
                            image, '%s:%s' % (url, final_imagefile)])
     # symlink numbered filename on local filesystem
     if osp.basename(final_imagefile) != image_base:
@@ -832,13 +889,13 @@ def create_user_image(
     base_image_pattern = base_image.format(base_directory=base_directory,
                                            extension=extension,
                                            **metadata)
-    base_images = glob.glob(base_image_pattern)
+    base_images = _glob_cached(base_image_pattern)
     if len(base_images) == 0:
         base_image_pattern_patch \
             = base_image.format(base_directory=base_directory,
                                 extension='-*%s' % extension,
                                 **metadata)
-        base_images = glob.glob(base_image_pattern_patch)
+        base_images = _glob_cached(base_image_pattern_patch)
         if len(base_images) == 0:
             raise ValueError(
                 'Cannot find file: {} or {}'.format(base_image_pattern,
@@ -905,17 +962,18 @@ def create_user_image(
         # will do it again
         # we use bash -c 'make...' in order to allow user .profile
         # customization (paths for Qt6 in pip install...)
-        sub_cmd = [
-            'bv_env_test',
-            'make',
-            'BRAINVISA_INSTALL_PREFIX=/casa/host/install'] \
-            + install_targets
+        # Both make invocations run in a single container: container
+        # startup (image mount + namespace setup) is paid only once.
+        make_cmd = ('bv_env_test make BRAINVISA_INSTALL_PREFIX='
+                    '/casa/host/install ')
+        sub_cmd = (make_cmd + ' '.join(install_targets)
+                   + ' && ' + make_cmd + 'post-install')
         retcode = run_container(
             config=config,
             command=[
                 'bash',
                 '-c',
-                ' '.join(sub_cmd)],
+                sub_cmd],
             gui=False,
             opengl="container",
             root=False,
@@ -928,53 +986,63 @@ def create_user_image(
         )
         if retcode != 0:
             sys.exit('make ' + ' '.join(install_targets)
-                     + ' failed, aborting.')
-        sub_cmd = ['bv_env_test',
-                   'make',
-                   'BRAINVISA_INSTALL_PREFIX=/casa/host/install',
-                   'post-install']
-        retcode = run_container(
-            config=config,
-            command=['bash',
-                     '-c',
-                     ' '.join(sub_cmd)],
-            gui=False,
-            opengl="container",
-            root=False,
-            cwd='/casa/host/build',
-            env={},
-            image=None,
-            container_options=None,
-            base_directory=base_directory,
-            verbose=verbose
-        )
-        if retcode != 0:
-            sys.exit('make post-install failed, aborting.')
+                     + ' or make post-install failed, aborting.')
 
     zip_archive = osp.join(config['directory'],
                            '%(distro)s-%(version)s-%(system)s.zip' % metadata)
     zip_json = '%s.json' % zip_archive
 
+    if zip:
+        install_dir = osp.join(config['directory'], 'install')
+        if not osp.isdir(install_dir):
+            sys.exit('cannot create the zip distribution: the install '
+                     'directory does not exist: ' + install_dir)
+        # Skip the whole zip step when the install tree is unchanged
+        # since the previous archive was built.
+        manifest = _install_manifest(install_dir)
+        old_zip_meta = None
+        if osp.exists(zip_json) and osp.exists(zip_archive):
+            with open(zip_json) as f:
+                old_zip_meta = json.load(f)
+        if old_zip_meta and old_zip_meta.get('manifest') == manifest:
+            zip = False
+            print('zip file is up to date:', zip_archive)
     if zip:
         print('Creating zip file for distro', distro, '...')
-        with zipfile.ZipFile(zip_archive, 'w', allowZip64=True,
-                             compression=zipfile.ZIP_DEFLATED) as zip:
-            for root, dirs, files in os.walk(osp.join(config['directory'],
-                                                      'install')):
-                rel = osp.relpath(root, osp.join(config['directory'],
-                                                 'install'))
-                for dir in dirs:
-                    zip.write(osp.join(root, dir), osp.join(rel, dir))
-                for file in files:
-                    zip.write(osp.join(root, file), osp.join(rel, file))
+        zip_exe = shutil.which('zip')
+        if zip_exe:
+            # Info-ZIP compresses much faster than the zipfile module on
+            # multi-GB install trees. -1 favors speed: most of the
+            # payload is already-compressed data.
+            if osp.exists(zip_archive):
+                # zip(1) would update an existing archive in place
+                os.remove(zip_archive)
+            subprocess.check_call(
+                [zip_exe, '-q', '-r', '-1', zip_archive, '.'],
+                cwd=install_dir)
+        else:
+            # iterative scandir traversal: a single stat per entry and
+            # arcnames derived by slicing instead of relpath/join
+            prefix_len = len(install_dir) + 1
+            with zipfile.ZipFile(zip_archive, 'w', allowZip64=True,
+                                 compression=zipfile.ZIP_DEFLATED) as zip:
+                stack = [install_dir]
+                while stack:
+                    with os.scandir(stack.pop()) as it:
+                        for entry in it:
+                            zip.write(entry.path, entry.path[prefix_len:])
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+        zip_size, zip_md5 = file_size_and_hash(zip_archive)
         zip_meta = {
-            'md5': file_hash(zip_archive),
-            'size': os.stat(zip_archive).st_size,
+            'md5': zip_md5,
+            'size': zip_size,
             'distro': distro,
             'system': config['system'],
             'image_version': config['image_version'],
             'version': version,
             'creation_time': datetime.datetime.now().isoformat(),
+            'manifest': manifest,
         }
         with open(zip_json, 'w') as jf:
             json.dump(zip_meta, jf, indent=4, separators=(',', ': '))
@@ -1004,11 +1072,10 @@ def create_user_image(
             print(msg)
 
         # Add image file md5 hash to JSON metadata file
-        metadata['size'] = os.stat(output).st_size
-        metadata['md5'] = file_hash(output)
+        metadata['size'], metadata['md5'] = file_size_and_hash(output)
         metadata['image_id'] = image_id
-        json.dump(metadata, open(metadata_file, 'w'),
-                  indent=4, separators=(',', ': '))
+        with open(metadata_file, 'w') as f:
+            json.dump(metadata, f, indent=4, separators=(',', ': '))
 
 
 @command
@@ -1033,7 +1100,8 @@ def publish_user_image(image):
     """
     files = [image + '.json', image]
     print('uploading files to server:')
-    subprocess.check_call(['rsync', '-P', '--progress', '--chmod=a+r']
+    subprocess.check_call(['rsync', '--partial', '--info=progress2',
+                           '--whole-file', '--chmod=a+r']
                           + files + [publish_url])
 
 
@@ -1056,6 +1124,8 @@ def bbi_daily(distro=None, branch=None, system=None,
               user_tests='yes',
               base_directory=casa_distro_directory(),
               install_thirdparty='none',
+              jobs='1',
+              test_jobs='1',
               verbose=None):
     '''BrainVISA Build infrastructure: daily/nightly automated tests
 
@@ -1160,6 +1230,16 @@ def bbi_daily(distro=None, branch=None, system=None,
     install_thirdparty
         default = {install_thirdparty_default}
         passed to "create_user_image" when update_user_images is true
+    jobs
+        default = {jobs_default}
+        Number of dev environments processed concurrently. The
+        per-environment pipelines (bv_maker, tests, user image creation)
+        are independent subprocess chains, so several of them can run in
+        parallel on a large build machine.
+    test_jobs
+        default = {test_jobs_default}
+        Number of test labels run concurrently within each environment
+        during the test phases.
     {base_directory}
     {verbose}
     '''
@@ -1171,6 +1251,7 @@ def bbi_daily(distro=None, branch=None, system=None,
     update_user_images = boolean_value(update_user_images)
     recreate_user_envs = boolean_value(recreate_user_envs)
     user_tests = boolean_value(user_tests)
+    jobs = int(jobs)
     base_directory = os.path.abspath(base_directory)
 
     # Ensure that all recursively called instances of casa_distro will use
@@ -1183,26 +1264,38 @@ def bbi_daily(distro=None, branch=None, system=None,
         from casa_distro.jenkins import BrainVISAJenkins
 
         jenkins_auth = jenkins_auth.format(base_directory=base_directory)
+        # only the two first lines are meaningful, do not read (and
+        # allocate) the whole file
         with open(jenkins_auth) as f:
-            jenkins_login, jenkins_password = [i.strip() for i in
-                                               f.readlines()[:2]]
+            jenkins_login = next(f).strip()
+            jenkins_password = next(f).strip()
         jenkins = BrainVISAJenkins(jenkins_server, jenkins_login,
                                    jenkins_password)
     else:
         jenkins = None
-    bbi_daily = BBIDaily(base_directory, jenkins=jenkins)
+    bbi_daily = BBIDaily(base_directory, jenkins=jenkins,
+                         test_jobs=int(test_jobs))
 
     if update_casa_distro:
         # Update casa_distro with git and restart with update_casa_distro=no
-        success = bbi_daily.update_casa_distro()
+        success, updated = bbi_daily.update_casa_distro()
         if not success:
+            bbi_daily.flush_logs()
             sys.exit('bbi_daily: failed to update casa-distro')
-        res = subprocess.call(
-            [sys.executable]
-            + [i for i in sys.argv if 'update_casa_distro' not in i]
-            + ['update_casa_distro=no']
-        )
-        sys.exit(res)
+        if updated:
+            # the restart below does not return: send pending log posts now
+            bbi_daily.flush_logs()
+            # Replace the current process instead of spawning a child and
+            # keeping the parent alive as a waiter (which doubled peak
+            # memory for the whole run). execv never returns and does not
+            # run atexit handlers, so flush everything first.
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execv(sys.executable,
+                     [sys.executable]
+                     + [i for i in sys.argv
+                        if 'update_casa_distro' not in i]
+                     + ['update_casa_distro=no'])
 
     successful_tasks = []
     failed_tasks = []
@@ -1234,30 +1327,39 @@ def bbi_daily(distro=None, branch=None, system=None,
             else:
                 failed_tasks.append('update_base_images')
 
-        if bv_maker_steps:
-            bv_maker_steps = bv_maker_steps.split(',')
-        for dev_config in dev_configs:
+        # computed once: the per-environment pipelines below only test
+        # this list for truth and iterate it
+        bv_maker_steps = bv_maker_steps.split(',') if bv_maker_steps else []
+
+        def process_dev_config(dev_config):
+            # Whole pipeline (build, tests, user image and environment,
+            # user tests) of one dev environment. Returns the
+            # (successful, failed) task labels of this environment;
+            # pipelines of different environments are independent, which
+            # allows running them concurrently with jobs > 1.
+            env_successful = []
+            env_failed = []
             doc_build_success = False
             if bv_maker_steps:
                 successful, failed = bbi_daily.bv_maker(dev_config,
                                                         bv_maker_steps)
-                successful_tasks.extend(
+                env_successful.extend(
                     '{0}: {1}'.format(dev_config['name'], i)
                     for i in successful)
-                failed_tasks.extend('{0}: {1}'.format(dev_config['name'], i)
-                                    for i in failed)
+                env_failed.extend('{0}: {1}'.format(dev_config['name'], i)
+                                  for i in failed)
                 if set(failed) - NONFATAL_BV_MAKER_STEPS:
                     # There is no point in running tests and creating a user
                     # image if compilation failed.
-                    continue
+                    return env_successful, env_failed
                 doc_build_success = ('doc' in successful)
             if dev_tests:
                 successful, failed = bbi_daily.tests(dev_config, dev_config)
-                successful_tasks.extend(
+                env_successful.extend(
                     '{0}: {1}'.format(dev_config['name'], i)
                     for i in successful)
-                failed_tasks.extend('{0}: {1}'.format(dev_config['name'], i)
-                                    for i in failed)
+                env_failed.extend('{0}: {1}'.format(dev_config['name'], i)
+                                  for i in failed)
 
             # TODO: implement tests in VirtualBox user images
             extension = '.sif'
@@ -1287,23 +1389,23 @@ def bbi_daily(distro=None, branch=None, system=None,
                     install_thirdparty=install_thirdparty
                 )
                 if success:
-                    successful_tasks.append('{0}: update user image'.format(
+                    env_successful.append('{0}: update user image'.format(
                         user_config['name']))
                 else:
-                    failed_tasks.append('{0}: update user image'.format(
+                    env_failed.append('{0}: update user image'.format(
                         user_config['name']))
-                    continue
+                    return env_successful, env_failed
 
             if (recreate_user_envs
                     or not os.path.exists(user_config['directory'])):
                 success = bbi_daily.recreate_user_env(user_config, dev_config)
                 if success:
-                    successful_tasks.append('{0}: recreate user env'.format(
+                    env_successful.append('{0}: recreate user env'.format(
                         user_config['name']))
                 else:
-                    failed_tasks.append('{0}: recreate user env'.format(
+                    env_failed.append('{0}: recreate user env'.format(
                         user_config['name']))
-                    continue
+                    return env_successful, env_failed
 
             # Reload the full user config from the installed user environment
             user_config = select_environment(
@@ -1311,11 +1413,33 @@ def bbi_daily(distro=None, branch=None, system=None,
 
             if user_tests:
                 successful, failed = bbi_daily.tests(user_config, dev_config)
-                successful_tasks.extend(
+                env_successful.extend(
                     '{0}: {1}'.format(user_config['name'], i)
                     for i in successful)
-                failed_tasks.extend('{0}: {1}'.format(user_config['name'], i)
-                                    for i in failed)
+                env_failed.extend('{0}: {1}'.format(user_config['name'], i)
+                                  for i in failed)
+            return env_successful, env_failed
+
+        # merge the results of each pipeline as soon as it completes,
+        # so that the summary built by the exception handler below
+        # still reports the tasks finished before a pipeline raised
+        results_lock = threading.Lock()
+
+        def run_dev_config(dev_config):
+            env_successful, env_failed = process_dev_config(dev_config)
+            with results_lock:
+                successful_tasks.extend(env_successful)
+                failed_tasks.extend(env_failed)
+
+        if jobs > 1 and len(dev_configs) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                # consuming the iterator re-raises the first pipeline
+                # exception once every pipeline has completed
+                list(pool.map(run_dev_config, dev_configs))
+        else:
+            for dev_config in dev_configs:
+                run_dev_config(dev_config)
     except Exception:
         log = ['Successful tasks']
         log.extend('  - {0}'.format(i) for i in successful_tasks)
@@ -1332,6 +1456,9 @@ def bbi_daily(distro=None, branch=None, system=None,
             log.extend('  - {0}'.format(i) for i in failed_tasks)
         bbi_daily.log(bbi_daily.bbe_name, 'finished',
                       (1 if failed_tasks else 0), '\n'.join(log))
+    finally:
+        # make sure all asynchronously queued Jenkins posts are sent
+        bbi_daily.flush_logs()
 
 
 @command
@@ -1399,12 +1526,13 @@ def local_install(type, action=None, version='*',
     build_file = build_files[0]
 
     builder = get_image_builder(build_file)
-    steps_todo = [i for i in (j.__name__ for j in builder.steps)
-                  if i not in installer.log.get(builder.name, {})]
+    done = installer.log.get(builder.name, {})
+    steps_todo = [i for i in (j.__name__ for j in builder.ordered_steps())
+                  if i not in done]
 
     if not action:
-        for step in builder.steps:
-            if step.__name__ in installer.log.get(builder.name, {}):
+        for step in builder.ordered_steps():
+            if step.__name__ in done:
                 status = 'done'
             else:
                 status = 'to do'
@@ -1415,7 +1543,9 @@ def local_install(type, action=None, version='*',
     elif action == 'all':
         step_names = steps_todo
     else:
-        step_names = ','.split(action)
+        # note: this used to read ','.split(action), which made any
+        # explicit action list run a nonexistent step named ","
+        step_names = [i.strip() for i in action.split(',') if i.strip()]
     for step_name in step_names:
         print('Performing', builder.name, '/', step_name)
         installer.perform_step(build_file, step_name)
@@ -1465,7 +1595,7 @@ def convert_image(source=None,
         if verbose:
             print('Looking for source in', base_pattern,
                   file=verbose)
-        bases = glob.glob(base_pattern + '.json')
+        bases = _glob_cached(base_pattern + '.json')
         if len(bases) == 0:
             # Raise appropriate error for non existing file
             open(source)
@@ -1477,7 +1607,8 @@ def convert_image(source=None,
     base = os.path.join(default_base_directory, source)  # make path absolute
 
     if osp.exists(base + '.json'):
-        metadata = json.load(open(base + '.json'))
+        with open(base + '.json') as f:
+            metadata = json.load(f)
         if not convert_from:
             convert_from = metadata['container_type']
     else:
@@ -1506,9 +1637,6 @@ def convert_image(source=None,
         print('from      ', base, file=verbose)
         pprint(metadata, stream=verbose, indent=4)
 
-    json.dump(metadata, open(metadata_output, 'w'),
-              indent=4, separators=(',', ': '))
-
     if container_type == 'vbox':
         module = casa_distro.vbox
     elif container_type == 'singularity':
@@ -1525,8 +1653,7 @@ def convert_image(source=None,
     if msg:
         print(msg)
     elif osp.isfile(output):
-        metadata['size'] = os.stat(output).st_size
-        metadata['md5'] = file_hash(output)
+        metadata['size'], metadata['md5'] = file_size_and_hash(output)
         metadata['image_id'] = image_id
-        json.dump(metadata, open(metadata_output, 'w'),
-                  indent=4, separators=(',', ': '))
+    with open(metadata_output, 'w') as f:
+        json.dump(metadata, f, indent=4, separators=(',', ': '))
@@ -12,6 +12,7 @@ import sys
 import time
 import subprocess
 import tempfile
+import urllib.error
 
 import casa_distro
 from casa_distro.environment import (prepare_environment_homedir, copytree, cp,
@@ -92,20 +93,27 @@ def download_install(install_dir, distro, version, url):
     print('download:', distro_url)
     local_zip = osp.join('/tmp', osp.basename(distro_url))
     json_url = '%s.json' % distro_url
+    # urllib raises HTTPError for 4xx statuses, so the former
+    # getcode() == 404 check could never trigger
     try:
-        f = None
-        try:
-            f = downloader.urlopen(json_url)
-            if f.getcode() == 404:
-                return
-            metadata = json.loads(f.read().decode('utf-8'))
-        except Exception as e:
-            print('%s could not be read:' % json_url, e)
+        f = downloader.urlopen(json_url)
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            # no archive published for this version/system, nothing to
+            # install
             return
+        print('%s could not be read:' % json_url, e)
+        return
+    except Exception as e:
+        print('%s could not be read:' % json_url, e)
+        return
+    try:
+        metadata = json.loads(f.read().decode('utf-8'))
+    except Exception as e:
+        print('%s could not be read:' % json_url, e)
+        return
     finally:
-        if f:
-            f.close()
-        del f
+        f.close()
 
     downloader.download_file(distro_url, local_zip,
                              allow_continue=True,
@@ -245,10 +253,9 @@ def setup_user(setup_dir='/casa/setup', rw_install=False, distro=None,
             image_id = json.load(f)
         environment['image_id'] = image_id['image_id']
 
-    json.dump(environment,
-              open(osp.join(setup_dir, 'conf',
-                            'casa_distro.json'), 'w'),
-              indent=4, separators=(',', ': '))
+    # indent=4 is kept on purpose: users are invited to edit this file
+    with open(osp.join(setup_dir, 'conf', 'casa_distro.json'), 'w') as f:
+        json.dump(environment, f, indent=4, separators=(',', ': '))
 
     prepare_environment_homedir(osp.join(setup_dir, 'home'), environment)
     print('The software is now setup in a new user environment.')
@@ -364,16 +371,18 @@ used anymore, you may as well delete it if you wish.
     if not osp.exists(casa_distro_json):
         print('ERROR - invalid distro:', distro, file=sys.stderr)
         sys.exit(1)
-    for i in os.listdir(distro_dir):
-        if i == 'casa_distro.json':
-            continue
-        fp = osp.join(distro_dir, i)
-        if osp.isdir(fp):
-            copytree(fp, osp.join(setup_dir, i))
-        else:
-            cp(fp, osp.join(setup_dir, i))
+    # scandir caches the entry type, no second stat per entry
+    with os.scandir(distro_dir) as entries:
+        for entry in entries:
+            if entry.name == 'casa_distro.json':
+                continue
+            if entry.is_dir():
+                copytree(entry.path, osp.join(setup_dir, entry.name))
+            else:
+                cp(entry.path, osp.join(setup_dir, entry.name))
 
-    environment = json.load(open(casa_distro_json))
+    with open(casa_distro_json) as f:
+        environment = json.load(f)
     environment.pop('description', None)
     environment.update({
         'casa_distro_compatibility': str(casa_distro.version_major),
@@ -440,10 +449,9 @@ used anymore, you may as well delete it if you wish.
         environment['image_id'] = image_id['image_id']
         environment['image_version'] = image_id['image_version']
 
-    json.dump(environment,
-              open(osp.join(setup_dir, 'conf',
-                            'casa_distro.json'), 'w'),
-              indent=4, separators=(',', ': '))
+    # indent=4 is kept on purpose: users are invited to edit this file
+    with open(osp.join(setup_dir, 'conf', 'casa_distro.json'), 'w') as f:
+        json.dump(environment, f, indent=4, separators=(',', ': '))
 
     prepare_environment_homedir(osp.join(setup_dir, 'home'), environment)
 
@@ -25,16 +25,41 @@ def get_docker_version():
     return [int(x) for x in r.group(1).split('.')]
 
 
+_yaml_cache = {}
+
+
+def _load_yaml_cached(path):
+    '''
+    Parse a YAML file, reusing the previous parse while the file is
+    unchanged (same mtime). The libyaml C loader is used when PyYAML
+    was built with it, it is an order of magnitude faster than the pure
+    Python loader. The returned object is shared between calls and must
+    not be mutated beyond the 'filename' and 'resolved_dependencies'
+    keys set by the caller.
+    '''
+    import yaml
+
+    mtime = os.stat(path).st_mtime_ns
+    cached = _yaml_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path) as f:
+        parsed = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader',
+                                             yaml.SafeLoader))
+    _yaml_cache[path] = (mtime, parsed)
+    return parsed
+
+
 def find_docker_image_files():
     '''
     Return a sorted list of dictionary corresponding to the content of
     all the "casa_distro_docker.yaml" files located in given directory.
     The result is sorted according to the dependencies declared in the files.
     '''
-    import yaml
-
     result = []
     dependencies = {}
+    raw_dependencies = []
+    yaml_roots = {}
 
     share_dirs = share_directories()
     base_dirs = [osp.abspath(osp.normpath(osp.join(share_directory, 'docker')))
@@ -43,134 +68,195 @@ def find_docker_image_files():
     for sh_id, share_directory in enumerate(share_dirs):
         base_directory = base_dirs[sh_id]
         for root, dirnames, filenames in os.walk(base_directory):
+            # prune hidden directories and the usual huge working trees
+            # (they never contain image definitions); os.walk honors the
+            # in-place mutation because it runs top-down
+            dirnames[:] = [d for d in dirnames
+                           if not d.startswith('.')
+                           and d not in ('__pycache__', 'build', 'install',
+                                         'pack', 'src')]
             if 'casa_distro_docker.yaml' in filenames:
                 yaml_filename = osp.normpath(
                     osp.join(root, 'casa_distro_docker.yaml'))
                 rel_root = osp.relpath(root, base_directory)
-                images_dict = yaml.load(open(yaml_filename))
+                images_dict = _load_yaml_cached(yaml_filename)
                 images_dict['filename'] = yaml_filename
                 deps = images_dict.get('dependencies')
                 if deps:
-                    for dependency in deps:
-                        # look for files in all docker base dirs
-                        for test_basedir in base_dirs:
-                            test_root = osp.join(test_basedir, rel_root)
-                            for r, d, f in os.walk(
-                                    osp.normpath(osp.join(test_root,
-                                                          dependency))):
-                                if 'casa_distro_docker.yaml' in f:
-                                    dependencies.setdefault(
-                                        yaml_filename,
-                                        set()).add(osp.normpath(
-                                            osp.join(
-                                                r,
-                                                'casa_distro_docker.yaml')))
+                    raw_dependencies.append((yaml_filename, rel_root, deps))
                 result.append(images_dict)
+                yaml_roots[osp.normpath(root)] = yaml_filename
+
+    # Resolve the declared dependencies against the directory index
+    # collected above, instead of re-walking the filesystem under every
+    # (yaml, dependency, share directory) combination. Like the walks
+    # it replaces, this matches every yaml found anywhere under the
+    # dependency directory, in any of the docker base dirs.
+    for yaml_filename, rel_root, deps in raw_dependencies:
+        for dependency in deps:
+            for test_basedir in base_dirs:
+                dep_root = osp.normpath(osp.join(test_basedir, rel_root,
+                                                 dependency))
+                dep_prefix = dep_root + os.sep
+                for yaml_root, dep_yaml in yaml_roots.items():
+                    if (yaml_root == dep_root
+                            or yaml_root.startswith(dep_prefix)):
+                        dependencies.setdefault(yaml_filename,
+                                                set()).add(dep_yaml)
+
+    # Complete the dependency sets transitively, visiting every edge
+    # once (the previous fixed-point loop rescanned all edges until
+    # nothing changed, and did so once per share directory).
+    closure = {}
+
+    def transitive_deps(path):
+        deps = closure.get(path)
+        if deps is None:
+            # pre-register an empty set so that dependency cycles
+            # terminate (with a partial closure, as before)
+            closure[path] = deps = set()
+            for dep in dependencies.get(path, ()):
+                deps.add(dep)
+                deps.update(transitive_deps(dep))
+        return deps
+
+    for path in list(dependencies):
+        dependencies[path] = set(transitive_deps(path))
+
+    for images_dict in result:
+        # resolved transitive dependencies, also used by
+        # create_docker_images to schedule independent builds
+        images_dict['resolved_dependencies'] = frozenset(
+            dependencies.get(images_dict['filename'], ()))
+
+    # The transitive dependency sets give a topological rank directly:
+    # if a depends on b, closure(a) strictly contains closure(b) plus b
+    # itself, so it is larger. File names break ties deterministically,
+    # as the previous pairwise comparator did. Plain key sorting avoids
+    # one comparator call (with its dict and set lookups) per
+    # comparison.
+    result.sort(key=lambda d: (len(d['resolved_dependencies']),
+                               d['filename']))
+    return result
 
-        propagate_dependencies = True
-        while propagate_dependencies:
-            propagate_dependencies = False
-            for i, d in dependencies.items():
-                for j in tuple(d):
-                    for k in dependencies.get(j, ()):
-                        i_deps = dependencies.setdefault(i, set())
-                        if k not in i_deps:
-                            i_deps.add(k)
-                            propagate_dependencies = True
-
-        def compare_with_dependencies(a, b):
-            if a['filename'] == b['filename']:
-                return 0
-            elif a['filename'] in dependencies.get(b['filename'], ()):
-                return -1
-            elif b['filename'] in dependencies.get(a['filename'], ()):
-                return 1
-            else:
-                if a['filename'] == b['filename']:
-                    return 0
-                elif a['filename'] < b['filename']:
-                    return -1
-                else:
-                    return 1
-                # return cmp(a['filename'], b['filename'])
-
-        def cmp_to_key(mycmp):
-            'Convert a cmp= function into a key= function'
-            class K(object):
 
-                def __init__(self, obj, *args):
-                    self.obj = obj
+_template_param_re = re.compile(r'%\((\w+)\)s')
 
-                def __lt__(self, other):
-                    return mycmp(self.obj, other.obj) < 0
 
-                def __gt__(self, other):
-                    return mycmp(self.obj, other.obj) > 0
+def _substitute_params(text, params):
+    # unknown %(name)s placeholders are left as they are instead of
+    # raising KeyError, and stray % characters need no escaping
+    return _template_param_re.sub(
+        lambda m: str(params[m.group(1)]) if m.group(1) in params
+        else m.group(0),
+        text)
 
-                def __eq__(self, other):
-                    return mycmp(self.obj, other.obj) == 0
 
-                def __le__(self, other):
-                    return mycmp(self.obj, other.obj) <= 0
+def _resolve_template_parameters(template_parameters):
+    '''
+    Expand %(name)s references between parameter values, so that a
+    template only needs one substitution pass whatever the nesting
+    depth. The fixed point runs on the (small) parameter dict instead
+    of rebuilding the whole template at every iteration.
+    '''
+    resolved = dict(template_parameters)
+    for key in resolved:
+        value = resolved[key]
+        while isinstance(value, str) and '%(' in value:
+            expanded = _substitute_params(value, resolved)
+            if expanded == value:
+                break
+            value = expanded
+        resolved[key] = value
+    return resolved
 
-                def __ge__(self, other):
-                    return mycmp(self.obj, other.obj) >= 0
 
-                def __ne__(self, other):
-                    return mycmp(self.obj, other.obj) != 0
-            return K
+def apply_template_parameters(template, template_parameters):
+    return _substitute_params(
+        template, _resolve_template_parameters(template_parameters))
 
-    return sorted(result, key=cmp_to_key(compare_with_dependencies))
 
+def _expand_image_source(image_source):
+    '''
+    Return (image_name, image_tags, template_parameters) for an
+    image_sources entry, resolving the template parameters only once
+    per source instead of once per substituted string.
+    '''
+    template_parameters = {
+        'casa_version': casa_distro.info.__version__}
+    template_parameters.update(
+        image_source.get('template_files_parameters', {}))
+    template_parameters = _resolve_template_parameters(template_parameters)
+    image_name = _substitute_params(image_source['name'],
+                                    template_parameters)
+    image_tags = [_substitute_params(i, template_parameters)
+                  for i in image_source['tags']]
+    return image_name, image_tags, template_parameters
+
+
+def compile_image_name_filters(filters):
+    '''
+    Precompile fnmatch-style image name filters into regular
+    expressions, to be passed to image_name_match. Compiling once per
+    command avoids re-translating the patterns for every image name.
+    '''
+    import fnmatch
 
-def apply_template_parameters(template, template_parameters):
-    while True:
-        result = template % template_parameters
-        if result == template:
-            break
-        template = result
-    return result
+    return [re.compile(fnmatch.translate(f)) for f in filters]
 
 
 def image_name_match(image_name, filters):
     '''
     Tests if an image name matches one of the filters.
-    It uses fnmatch syntax.
+    Filters are regular expressions returned by
+    compile_image_name_filters (fnmatch syntax).
     '''
-    import fnmatch
-
     for f in filters:
-        if fnmatch.fnmatch(image_name, f):
+        if f.match(image_name):
             return True
 
     return False
 
 
-def update_docker_images(image_name_filters=['*']):
-    image_file_count = 0
-    for images_dict in find_docker_image_files():
-        for image_source in images_dict['image_sources']:
-            template_parameters = {
-                'casa_version': casa_distro.info.__version__}
-            template_parameters.update(
-                image_source.get('template_files_parameters', {}))
+def _run_image_commands(commands, jobs, check=False):
+    '''
+    Run a list of independent docker commands, concurrently when
+    jobs > 1 (pulls and pushes of different images do not depend on
+    each other). With check=True a failing command raises
+    CalledProcessError, like subprocess.check_call.
+    '''
+    def run_one(cmd):
+        print('-' * 70)
+        print(*cmd)
+        print('-' * 70)
+        if check:
+            check_call(cmd)
+        else:
+            call(cmd)
+
+    if jobs > 1 and len(commands) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(run_one, commands))
+    else:
+        for cmd in commands:
+            run_one(cmd)
 
-            image_name = apply_template_parameters(
-                image_source['name'], template_parameters)
 
-            image_tags = [apply_template_parameters(i, template_parameters)
-                          for i in image_source['tags']]
+def update_docker_images(image_name_filters=['*'], jobs=1):
+    jobs = int(jobs)
+    image_name_filters = compile_image_name_filters(image_name_filters)
+    commands = []
+    for images_dict in find_docker_image_files():
+        for image_source in images_dict['image_sources']:
+            image_name, image_tags, _ = _expand_image_source(image_source)
             tag = image_tags[-1]
             image_full_name = 'cati/%s:%s' % (image_name, tag)
             if not image_name_match(image_full_name, image_name_filters):
                 continue
-            image_file_count += 1
-            cmd = ['docker', 'pull', image_full_name]
-            print('-' * 70)
-            print(*cmd)
-            print('-' * 70)
-            call(cmd)
-    return image_file_count
+            commands.append(['docker', 'pull', image_full_name])
+    _run_image_commands(commands, jobs)
+    return len(commands)
 
 
 def get_image_id(image_full_name):
@@ -235,149 +321,157 @@ def rm_images(images):
 
 
 def create_docker_images(image_name_filters=['*'],
-                         no_host_network=False):
+                         no_host_network=False,
+                         jobs=1):
     '''
     Creates all docker images that are declared in
     find_docker_image_files().
-    Return the number of images processed.
+    Return the number of images processed. With jobs > 1, images whose
+    dependency ranks are equal (and which therefore cannot depend on
+    each other) are built concurrently, level by level.
 
     This function is still work in progress. Its parameters and behaviour may
     change.
 
 
     '''
-    image_file_count = 0
+    jobs = int(jobs)
+    image_name_filters = compile_image_name_filters(image_name_filters)
     to_clean = []
-    try:
-        for images_dict in find_docker_image_files():
-            base_directory = tempfile.mkdtemp()
-            try:
-                source_directory, filename = osp.split(images_dict['filename'])
-                for image_source in images_dict['image_sources']:
-                    template_parameters = {
-                        'casa_version': casa_distro.info.__version__}
-                    template_parameters.update(
-                        image_source.get('template_files_parameters', {}))
-
-                    image_name = apply_template_parameters(
-                        image_source['name'], template_parameters)
-
-                    image_tags = [
-                        apply_template_parameters(i, template_parameters)
-                        for i in image_source['tags']]
-                    target_directory = osp.join(
-                        base_directory, image_name, image_tags[-1])
-                    os.makedirs(target_directory)
-                    for f in os.listdir(source_directory):
-                        if f == filename:
+
+    def build_images_dict(images_dict):
+        image_file_count = 0
+        base_directory = tempfile.mkdtemp()
+        try:
+            source_directory, filename = osp.split(images_dict['filename'])
+            for image_source in images_dict['image_sources']:
+                image_name, image_tags, template_parameters = \
+                    _expand_image_source(image_source)
+                target_directory = osp.join(
+                    base_directory, image_name, image_tags[-1])
+                os.makedirs(target_directory)
+                # scandir caches the file type from readdir, no
+                # per-entry stat is needed to classify entries
+                with os.scandir(source_directory) as entries:
+                    for entry in entries:
+                        if entry.name == filename:
                             continue
-                        source = osp.join(source_directory, f)
-                        target = osp.join(target_directory, f)
+                        target = osp.join(target_directory, entry.name)
 
-                        if osp.isdir(source):
+                        if entry.is_dir():
                             if os.path.exists(target):
                                 shutil.rmtree(target)
-                            shutil.copytree(source, target)
-                        elif f.endswith('.template'):
-                            content = apply_template_parameters(
-                                open(source).read(),
-                                template_parameters
-                            )
-                            open(target[:-9], 'w').write(content)
+                            shutil.copytree(entry.path, target)
+                        elif entry.name.endswith('.template'):
+                            with open(entry.path) as f:
+                                content = apply_template_parameters(
+                                    f.read(), template_parameters)
+                            with open(target[:-9], 'w') as f:
+                                f.write(content)
                         else:
-                            shutil.copy2(source, target)
-
-                    image_full_name = 'cati/%s:%s' % (
-                        image_name, image_tags[-1])
-
-                    if not image_name_match(image_full_name,
-                                            image_name_filters):
-                        continue
-                    image_file_count += 1
-
-                    old_id = get_image_id(image_full_name)
-                    old_base_id = None
-                    deps = images_dict.get('dependencies', [])
-                    if len(deps) == 0:
-                        base_image = get_base_image(
-                            os.path.join(target_directory, 'Dockerfile'))
-                        if base_image:
-                            old_base_id = pull_image(base_image)
-
-                    docker_ver = get_docker_version()
-                    # Docker 1.13 adds the --network option to build commands.
-                    # This is useful to avoid a DNS (/etc/resolv.conf) problem
-                    # happening on many Ubuntu computers where the host
-                    # /etc/resolv.conf uses 127.0.0.1 Unfortunately it is not
-                    # available in older releases of docker, including
-                    # those shipped in Ubuntu 16.04 (which is 1.12).
-                    if not no_host_network and docker_ver >= [1, 13]:
-                        cmd = ['docker', 'build', '--network=host']
-                    else:
-                        cmd = ['docker', 'build']
-                    cmd += ['--force-rm', '--tag', image_full_name,
-                            target_directory]
-                    print('-' * 40)
-                    print('Creating image %s' % image_full_name)
-                    print(*cmd)
-                    print('Docker context:', os.listdir(target_directory))
-                    print('-' * 40)
-                    check_call(cmd)
-                    if old_id is not None \
-                            and get_image_id(image_full_name) != old_id:
-                        to_clean.append(old_id)
-                    if old_base_id:
-                        to_clean.append(old_base_id)
-                    print('-' * 40)
-                    for tag in image_tags[:-1]:
-                        src = 'cati/%s:%s' % (image_name, image_tags[-1])
-                        dst = 'cati/%s:%s' % (image_name, tag)
-                        print('Creating tag', dst, 'from', src)
-                        # I do not know how to create a tag of an existing
-                        # image with docker-py, therefore I use subprocess
-                        check_call(['docker', 'tag', src, dst])
-                    print('-' * 40)
-            finally:
-                shutil.rmtree(base_directory)
+                            shutil.copy2(entry.path, target)
+
+                image_full_name = 'cati/%s:%s' % (
+                    image_name, image_tags[-1])
+
+                if not image_name_match(image_full_name,
+                                        image_name_filters):
+                    continue
+                image_file_count += 1
+
+                old_id = get_image_id(image_full_name)
+                old_base_id = None
+                deps = images_dict.get('dependencies', [])
+                if len(deps) == 0:
+                    base_image = get_base_image(
+                        os.path.join(target_directory, 'Dockerfile'))
+                    if base_image:
+                        old_base_id = pull_image(base_image)
+
+                docker_ver = get_docker_version()
+                # Docker 1.13 adds the --network option to build commands.
+                # This is useful to avoid a DNS (/etc/resolv.conf) problem
+                # happening on many Ubuntu computers where the host
+                # /etc/resolv.conf uses 127.0.0.1 Unfortunately it is not
+                # available in older releases of docker, including
+                # those shipped in Ubuntu 16.04 (which is 1.12).
+                if not no_host_network and docker_ver >= [1, 13]:
+                    cmd = ['docker', 'build', '--network=host']
+                else:
+                    cmd = ['docker', 'build']
+                cmd += ['--force-rm', '--tag', image_full_name,
+                        target_directory]
+                print('-' * 40)
+                print('Creating image %s' % image_full_name)
+                print(*cmd)
+                print('Docker context:', os.listdir(target_directory))
+                print('-' * 40)
+                check_call(cmd)
+                if old_id is not None \
+                        and get_image_id(image_full_name) != old_id:
+                    to_clean.append(old_id)
+                if old_base_id:
+                    to_clean.append(old_base_id)
+                print('-' * 40)
+                for tag in image_tags[:-1]:
+                    src = 'cati/%s:%s' % (image_name, image_tags[-1])
+                    dst = 'cati/%s:%s' % (image_name, tag)
+                    print('Creating tag', dst, 'from', src)
+                    # I do not know how to create a tag of an existing
+                    # image with docker-py, therefore I use subprocess
+                    check_call(['docker', 'tag', src, dst])
+                print('-' * 40)
+        finally:
+            shutil.rmtree(base_directory)
+        return image_file_count
+
+    image_file_count = 0
+    try:
+        images_dicts = find_docker_image_files()
+        if jobs > 1 and len(images_dicts) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            levels = {}
+            for images_dict in images_dicts:
+                levels.setdefault(len(images_dict['resolved_dependencies']),
+                                  []).append(images_dict)
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                for level in sorted(levels):
+                    # each level only starts once the previous one (its
+                    # potential dependencies) is fully built
+                    image_file_count += sum(pool.map(build_images_dict,
+                                                     levels[level]))
+        else:
+            for images_dict in images_dicts:
+                image_file_count += build_images_dict(images_dict)
     finally:
         rm_images(to_clean)
     return image_file_count
 
 
-def publish_docker_images(image_name_filters=['*']):
+def publish_docker_images(image_name_filters=['*'], jobs=1):
     '''
     Publish, on DockerHub, all docker images that are declared in
     find_docker_image_files().
-    Return the number of images processed.
+    Return the number of images processed. Pushes of different images
+    are independent and run concurrently when jobs > 1.
 
     This function is still work in progress. Its parameters and behaviour may
     change.
     '''
-    import casa_distro
-
-    image_file_count = 0
+    jobs = int(jobs)
+    image_name_filters = compile_image_name_filters(image_name_filters)
+    commands = []
     for images_dict in find_docker_image_files():
         source_directory, filename = osp.split(images_dict['filename'])
         for image_source in images_dict['image_sources']:
-            template_parameters = {
-                'casa_version': casa_distro.info.__version__}
-            template_parameters.update(
-                image_source.get('template_files_parameters', {}))
-
-            image_name = apply_template_parameters(
-                image_source['name'], template_parameters)
-
-            image_tags = [apply_template_parameters(i, template_parameters)
-                          for i in image_source['tags']]
+            image_name, image_tags, _ = _expand_image_source(image_source)
             for tag in image_tags:
                 image_full_name = 'cati/%s:%s' % (image_name, tag)
                 if not image_name_match(image_full_name, image_name_filters):
                     continue
-                image_file_count += 1
-                print('-' * 70)
-                print('pushing image:', image_full_name)
-                check_call(['docker', 'push', image_full_name])
-    return image_file_count
+                commands.append(['docker', 'push', image_full_name])
+    _run_image_commands(commands, jobs, check=True)
+    return len(commands)
 
 
 def update_docker_image(container_image):
@@ -65,7 +65,7 @@ def download_file_internal(url, dest, timeout=10., callback=None,
         incomplete download of the same file, and append the remaining of the
         remote file.
     '''
-    buffer_size = 1024 * 4
+    buffer_size = 1024 * 1024
     input = urlopen(url, timeout=timeout)
     info = input.info()
     size = int(info.get('Content-Length', 0))
@@ -95,19 +95,21 @@ def download_file_internal(url, dest, timeout=10., callback=None,
         while True:
             try:
                 buffer = input.read(buffer_size)
-                if buffer:
-                    output.write(buffer)
-                    dl_len += len(buffer)
-                    if callback and time.time() - last_time >= cbk_interval:
-                        speed = (dl_len - last_pos) / (time.time() - last_time)
-                        last_pos = dl_len
-                        last_time = time.time()
-                        callback(base_url, dl_len, size, speed, block,
-                                 cbk_count)
-                        cbk_count += 1
-                block += 1
-                if len(buffer) < buffer_size:
+                if not buffer:
+                    # read() returns an empty buffer only at the end of
+                    # the stream; a short read is not a reliable end
+                    # condition (e.g. on chunked transfer encoding)
                     break
+                output.write(buffer)
+                dl_len += len(buffer)
+                if callback and time.time() - last_time >= cbk_interval:
+                    speed = (dl_len - last_pos) / (time.time() - last_time)
+                    last_pos = dl_len
+                    last_time = time.time()
+                    callback(base_url, dl_len, size, speed, block,
+                             cbk_count)
+                    cbk_count += 1
+                block += 1
             except socket.timeout:
                 # print('*** timeout ***')
                 # print('resume at:', dl_len)
@@ -166,7 +168,9 @@ def stdout_progress(url, pos, size, speed, block, count):
         spstr = '%.2fB/s' % speed
     perstr = '%d' % int((float(pos) / size) * 100) + '%'
 
-    time_left = float(size - pos) / speed
+    # speed stays at 0 when the download finishes before the first
+    # callback interval, avoid a division by zero
+    time_left = float(size - pos) / speed if speed else 0.
     if time_left > 3600:
         timestr = '%dh%2dm' \
             % (int(math.floor(time_left / 3600)),
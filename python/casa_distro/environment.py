@@ -1,32 +1,55 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 
+import copy
 import errno
 import fnmatch
 import getpass
-from glob import glob
+from glob import glob, has_magic
+import hashlib
 import json
-import locale
 import os
 import os.path as osp
+import queue
 import re
 import shutil
 import socket
 import stat
 import subprocess
 import sys
+import threading
 import time
-import tempfile
+import traceback
 
-from casa_distro import six
 from casa_distro.six.moves import shlex_quote
 
 from casa_distro import share_directories
 from casa_distro import singularity
-from casa_distro.web import url_listdir
+from casa_distro.web import url_listdir, url_listdir_cached, \
+    urlopen
 from casa_distro import downloader
 
 
+_json_cache = {}
+
+
+def _load_json_cached(path):
+    '''
+    Read a small JSON file through a process-wide cache keyed by
+    modification time and size, so that the same configuration files
+    are not re-read and re-parsed by every enumeration. A deep copy is
+    returned: several callers modify the loaded configurations.
+    '''
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _json_cache.get(path)
+    if cached is None or cached[0] != key:
+        with open(path) as f:
+            cached = (key, json.load(f))
+        _json_cache[path] = cached
+    return copy.deepcopy(cached[1])
+
+
 bv_maker_branches = {
     'latest_release': 'latest_release',
     'master': 'master',
@@ -35,6 +58,8 @@ bv_maker_branches = {
     'trunk': 'integration',
 }
 
+_size_re = re.compile(r'^(\d+(?:\.\d+)?)\s*([KMG]?)$')
+
 image_re = re.compile(
     r'(?P<name>[\w-]+)'
     r'(?:-(?P<version>\d+\.\d+(?:\.\d+)?)'
@@ -142,8 +167,13 @@ def copytree(src, dst, symlinks=False, ignore=None):
     not be copied.
     XXX Consider this example code rather than the ultimate tool.
     """
+    entry_map = {}
     if os.path.isdir(src):
-        names = os.listdir(src)
+        # scandir caches the entry types, saving the per-name
+        # islink/isdir stat calls of the copy loop below
+        with os.scandir(src) as it:
+            entry_map = {entry.name: entry for entry in it}
+        names = list(entry_map)
         dstnames = names
     else:
         names = [os.path.basename(src)]
@@ -165,19 +195,31 @@ def copytree(src, dst, symlinks=False, ignore=None):
         os.makedirs(dst)
 
     errors = []
+    # the prefixes are constant across the loop: plain concatenation
+    # avoids os.path.join's per-call argument normalization
+    src_prefix = src + os.sep if src and not src.endswith(os.sep) else src
+    dst_prefix = dst + os.sep if dst and not dst.endswith(os.sep) else dst
     for name, new_name in zip(names, dstnames):
         if name in ignored_names:
             continue
-        srcname = os.path.join(src, name)
-        dstname = os.path.join(dst, new_name)
-        if symlinks and os.path.islink(srcname):
+        srcname = src_prefix + name
+        dstname = dst_prefix + new_name
+        entry = entry_map.get(name)
+        is_link = (entry.is_symlink() if entry is not None
+                   else os.path.islink(srcname))
+        if symlinks and is_link:
             linkto = os.readlink(srcname)
             os.symlink(linkto, dstname)
-        elif os.path.isdir(srcname):
+        elif (entry.is_dir() if entry is not None
+              else os.path.isdir(srcname)):
             copytree(srcname, dstname, symlinks, ignore)
         else:
-            # Will raise a SpecialFileError for unsupported file types
-            copy2(srcname, dstname)
+            # Will raise a SpecialFileError for unsupported file types.
+            # shutil.copyfile already uses the sendfile zero-copy fast
+            # path; dstname is a full file path here so copy2's isdir
+            # probe (one stat per file) is not needed.
+            shutil.copyfile(srcname, dstname)
+            copystat(srcname, dstname)
     copystat(src, dst)
     if errors:
         raise shutil.Error(errors)
@@ -210,7 +252,7 @@ def string_to_byte_count(size):
         'M': 1024 ** 2,
         'G': 1024 ** 3}
 
-    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMG]?)$', size)
+    match = _size_re.match(size)
     if not match:
         raise ValueError('Invlid file system size: {0}'.format(size))
     n = float(match.group(1))
@@ -218,6 +260,20 @@ def string_to_byte_count(size):
     return int(n * coef)
 
 
+def _write_json_atomic(path, data, newline=False, **dump_kwargs):
+    '''
+    Write a JSON file atomically: the content goes to a temporary
+    sibling first and is moved into place with os.replace, so an
+    interrupted write cannot leave a truncated configuration behind.
+    '''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, **dump_kwargs)
+        if newline:
+            f.write('\n')
+    os.replace(tmp, path)
+
+
 def update_config(config, update):
     """
     Update a configuration dictionary with an update configuration dictionary.
@@ -225,29 +281,51 @@ def update_config(config, update):
     two dictionaries (dictionaries are merged recursively, lists are
     concatenated)
     """
-    for k, v in update.items():
-        if k not in config:
-            config[k] = v
-        else:
-            oldv = config[k]
-            if isinstance(oldv, dict):
-                update_config(oldv, v)
-            elif isinstance(oldv, list):
-                oldv += v
+    # iterative merge: the nested config dicts are merged for every
+    # environment on every enumeration, recursion frames add up
+    stack = [(config, update)]
+    while stack:
+        dst, src = stack.pop()
+        for k, v in src.items():
+            if k not in dst:
+                dst[k] = v
             else:
-                config[k] = v
+                oldv = dst[k]
+                if isinstance(oldv, dict):
+                    stack.append((oldv, v))
+                elif isinstance(oldv, list):
+                    oldv.extend(v)
+                else:
+                    dst[k] = v
+
+
+_find_in_path_cache = {}
 
 
 def find_in_path(file):
     '''Look for a file in directories of the ``PATH`` environment variable.
+
+    Results are memoized per (file, PATH) pair: the same executables are
+    looked up repeatedly during a single invocation.
     '''
-    path = os.environ.get('PATH').split(os.pathsep)
-    for i in path:
+    path = os.environ.get('PATH')
+    key = (file, path)
+    try:
+        return _find_in_path_cache[key]
+    except KeyError:
+        pass
+    result = None
+    for i in path.split(os.pathsep):
         p = osp.normpath(osp.abspath(i))
         if p:
-            r = glob(osp.join(p, file))
-            if r:
-                return r[0]
+            # all callers pass literal file names: a single stat beats
+            # glob's directory listing and pattern machinery
+            candidate = osp.join(p, file)
+            if osp.isfile(candidate):
+                result = candidate
+                break
+    _find_in_path_cache[key] = result
+    return result
 
 
 def iter_distros():
@@ -258,16 +336,20 @@ def iter_distros():
     """
     for share_directory in share_directories():
         distro_dir = osp.join(share_directory, 'distro')
-        if not osp.isdir(distro_dir):
+        try:
+            entries = os.scandir(distro_dir)
+        except OSError:
             continue
-        for basename in os.listdir(distro_dir):
-            casa_distro_json = osp.join(distro_dir, basename,
-                                        'casa_distro.json')
-            if osp.isfile(casa_distro_json):
-                with open(casa_distro_json) as f:
-                    distro = json.load(f)
-                distro['directory'] = osp.join(distro_dir, basename)
-                yield distro
+        with entries:
+            for entry in entries:
+                # the entry type comes from readdir, no stat needed
+                if not entry.is_dir():
+                    continue
+                casa_distro_json = osp.join(entry.path, 'casa_distro.json')
+                if osp.isfile(casa_distro_json):
+                    distro = _load_json_cached(casa_distro_json)
+                    distro['directory'] = entry.path
+                    yield distro
 
 
 def select_distro(distro):
@@ -282,7 +364,7 @@ def select_distro(distro):
         casa_distro_json = osp.join(
             directory, 'conf', 'casa_distro.json')
         if osp.exists(casa_distro_json):
-            distro = json.load(open(casa_distro_json))
+            distro = _load_json_cached(casa_distro_json)
             distro['directory'] = directory
             return distro
     raise ValueError('Invalid distro: {0}'.format(distro))
@@ -305,56 +387,90 @@ def casa_distro_directory():
     return _casa_distro_directory
 
 
+_user_config_filename = None
+
+
 def user_config_filename():
     """
     Get the user configuration file for casa-distro. This user config is
     outside of environments in order to allow configuration of read-only shared
-    environments.
+    environments. The location is resolved once per process.
     """
-    xdg_config_home = os.environ.get('XDG_CONFIG_HOME', '')
-    if not xdg_config_home:
-        xdg_config_home = osp.expanduser('~/.config')
-    user_config_file = osp.join(xdg_config_home,
-                                'casa-distro', 'casa_distro_3.json')
-    return user_config_file
+    global _user_config_filename
+
+    if _user_config_filename is None:
+        xdg_config_home = os.environ.get('XDG_CONFIG_HOME', '')
+        if not xdg_config_home:
+            xdg_config_home = osp.expanduser('~/.config')
+        _user_config_filename = osp.join(xdg_config_home,
+                                         'casa-distro', 'casa_distro_3.json')
+    return _user_config_filename
 
 
-def iter_environments(base_directory=casa_distro_directory(), **filter):
+def iter_environments(base_directory=None, **filter):
     """
     Iterate over environments created with "setup" or "setup_dev" commands
     in the given
-    base directory. For each one, yield a dictionary corresponding to the
+    base directory (default: casa_distro_directory()). For each one,
+    yield a dictionary corresponding to the
     casa_distro.json file with the "directory" item added.
     """
-    casa_distro_jsons = set(glob(osp.join(base_directory, '*',
-                                          'conf', 'casa_distro.json')))
-    casa_dir = os.environ.get('CASA_DIR')
-    if casa_dir:
-        casa_distro_jsons.update(glob(osp.join(casa_dir, 'conf',
-                                               'casa_distro.json')))
-    for casa_distro_json in sorted(casa_distro_jsons):
-        with open(casa_distro_json) as f:
-            environment_config = json.load(f)
-        directory = osp.dirname(osp.dirname(casa_distro_json))
-        config = {}
-        config['config_files'] = [casa_distro_json]
-        config['directory'] = directory
-        config['mounts'] = {
+    if base_directory is None:
+        # resolved at call time: a default argument would freeze the
+        # value of CASA_BASE_DIRECTORY as of module import
+        base_directory = casa_distro_directory()
+    user_config_file = user_config_filename()
+    # compile the filter patterns once per call; literal patterns (the
+    # common case, e.g. name=...) use plain equality
+    compiled_filters = []
+    for k, p in filter.items():
+        if p is None:
+            continue
+        if isinstance(p, str) and not has_magic(p):
+            compiled_filters.append((k, p, None))
+        else:
+            compiled_filters.append((k, None,
+                                     re.compile(fnmatch.translate(p))))
+    directory = filter.get('directory')
+    if directory and not has_magic(directory):
+        # selecting an exact directory does not require scanning (and
+        # parsing the configuration of) every environment of the base
+        # directory
+        casa_distro_jsons = set(glob(osp.join(directory, 'conf',
+                                              'casa_distro.json')))
+    else:
+        casa_distro_jsons = set(glob(osp.join(base_directory, '*',
+                                              'conf', 'casa_distro.json')))
+        casa_dir = os.environ.get('CASA_DIR')
+        if casa_dir:
+            casa_distro_jsons.update(glob(osp.join(casa_dir, 'conf',
+                                                   'casa_distro.json')))
+    # this part of the configuration is the same for every
+    # environment, build it once and copy it per environment
+    config_template = {
+        'mounts': {
             '/casa/host': '{directory}',
             '/host': '/',
-        }
-        if 'WSL_DISTRO_NAME' in os.environ:
-            # On Winows/WSL2, /dev/shm is a symlink to /run/shm. This
-            # is supposed to be a directory-like device stored in memory.
-            # To avoid failure of some programs, /run/shm is mounted as
-            # /tmp so that it behave like a writable directory as expected.
-            config['mounts']['/run/shm'] = '/tmp'
-        config['env'] = {
+        },
+        'env': {
             'CASA_ENVIRONMENT': '{name}',
             'CASA_SYSTEM': '{system}',
             'CASA_HOST_DIR': '{directory}',
             'CASA_DISTRO': '{distro}',
-        }
+        },
+    }
+    if 'WSL_DISTRO_NAME' in os.environ:
+        # On Winows/WSL2, /dev/shm is a symlink to /run/shm. This
+        # is supposed to be a directory-like device stored in memory.
+        # To avoid failure of some programs, /run/shm is mounted as
+        # /tmp so that it behave like a writable directory as expected.
+        config_template['mounts']['/run/shm'] = '/tmp'
+    for casa_distro_json in sorted(casa_distro_jsons):
+        environment_config = _load_json_cached(casa_distro_json)
+        directory = osp.dirname(osp.dirname(casa_distro_json))
+        config = copy.deepcopy(config_template)
+        config['config_files'] = [casa_distro_json]
+        config['directory'] = directory
         if 'bv_maker_branch' in config:
             config['env']['CASA_BRANCH'] = config['bv_maker_branch']
         if environment_config['container_type'] == 'singularity':
@@ -364,19 +480,21 @@ def iter_environments(base_directory=casa_distro_directory(), **filter):
 
         update_config(config, environment_config)
 
-        user_config_file = user_config_filename()
         for additional_config_file in [user_config_file]:
             if osp.exists(additional_config_file):
                 config['config_files'].append(additional_config_file)
-                with open(additional_config_file) as f:
-                    update_config(config, json.load(f))
+                update_config(config,
+                              _load_json_cached(additional_config_file))
 
         match = False
-        for k, p in filter.items():
-            if p is None:
-                continue
+        for k, literal, pattern in compiled_filters:
             v = config.get(k)
-            if v is None or not fnmatch.filter([v], p):
+            if v is None:
+                break
+            if literal is not None:
+                if v != literal:
+                    break
+            elif not pattern.match(v):
                 break
         else:
             match = True
@@ -399,32 +517,38 @@ def get_run_base_of_dev_image(image, url=None):
             version = m.group('version')
             extension = m.group('extension')
 
-            tmpi = tempfile.mkstemp(prefix='casa_distro', suffix='.json')
-            os.close(tmpi[0])
-            tmp = tmpi[1]
-            try:
-                for file in url_listdir(url):
-                    if not file.endswith('.' + extension):
-                        continue
-                    other_base = osp.basename(file)
-                    m = image_re.match(other_base)
-                    if (m and
-                            m.group('version') == version and
-                            m.group('extension') == extension):  # noqa: E129
-                        other_json = osp.join(url, file + '.json')
-                        downloader.download_file(
-                            other_json,
-                            tmp,
-                            allow_continue=False,
-                            use_tmp=False,
-                            method='internal')
-                        with open(tmp) as f:
-                            im_meta = json.load(f)
-                        other_id = im_meta.get('image_id')
-                        if other_id is not None and other_id == run_id:
-                            return osp.join(dirname, file)
-            finally:
-                os.unlink(tmp)
+            def remote_metadata(filename):
+                # metadata files are tiny: fetch them straight into
+                # memory rather than through a temporary download file
+                response = urlopen(osp.join(url, filename + '.json'),
+                                   timeout=10)
+                return json.loads(response.read().decode('utf-8'))
+
+            if '-dev-' in base:
+                # The matching run image conventionally has the same
+                # name with -run- substituted: probe it directly
+                # before paying for a full directory listing and one
+                # JSON download per candidate.
+                candidate = base.replace('-dev-', '-run-', 1)
+                try:
+                    im_meta = remote_metadata(candidate)
+                    if (run_id is not None
+                            and im_meta.get('image_id') == run_id):
+                        return osp.join(dirname, candidate)
+                except Exception:
+                    pass  # fall back to the directory listing
+            for file in url_listdir(url):
+                if not file.endswith('.' + extension):
+                    continue
+                other_base = osp.basename(file)
+                m = image_re.match(other_base)
+                if (m and
+                        m.group('version') == version and
+                        m.group('extension') == extension):  # noqa: E129
+                    im_meta = remote_metadata(file)
+                    other_id = im_meta.get('image_id')
+                    if other_id is not None and other_id == run_id:
+                        return osp.join(dirname, file)
 
     if url is None:
         # FIXME: this could yield a mismatch between casa-run and casa-dev
@@ -452,7 +576,9 @@ def find_image_update_url(image, url):
         extension = m.group('extension')
         patch = int(patch or 0)
         new_patch = patch
-        for file in url_listdir(url):
+        # pull_image calls this once per image with the same url, the
+        # cached listing avoids one index fetch per image
+        for file in url_listdir_cached(url):
             other_base = osp.basename(file)
             m = image_re.match(other_base)
             if (m and
@@ -538,16 +664,18 @@ def update_image(image, new_image_url, config_files=[], restart=False,
             metadata['image_id'] = image_id
         else:
             metadata.pop('image_id', None)
-        with open(filename, 'w') as f:
-            json.dump(metadata, f,
-                      indent=4, separators=(',', ': '))
+        # a truncated casa_distro.json would break the environment
+        _write_json_atomic(filename, metadata,
+                           indent=4, separators=(',', ': '))
 
-    # Finally remove old image
+    # Finally remove old image (a single unlink attempt per file
+    # instead of an exists probe followed by the removal)
     if cleanup and osp.abspath(image) != osp.abspath(new_image):
-        if osp.exists(image):
-            os.remove(image)
-        if osp.exists(image + '.json'):
-            os.remove(image + '.json')
+        for obsolete in (image, image + '.json'):
+            try:
+                os.remove(obsolete)
+            except FileNotFoundError:
+                pass
 
 
 def select_environment(base_directory, **kwargs):
@@ -567,6 +695,9 @@ def select_environment(base_directory, **kwargs):
                      .format(base_directory, kwargs))
 
 
+_standard_dirs_to_mount = None
+
+
 def standard_dirs_to_mount():
     """List "standard" mount points that exist on the host machine.
 
@@ -575,13 +706,20 @@ def standard_dirs_to_mount():
       store useful data;
     - directories that are used in NeuroSpin for storing data or installed
       software.
+
+    The host filesystem layout is probed once per process (it is stable
+    for the process lifetime, and this runs on every container start).
     """
-    standard_dirs = (['/home', '/mnt', '/media', '/srv',
-                      '/neurospin', '/drf', '/i2bm', '/nfs']
-                     + glob('/volatile*'))
-    for dirname in standard_dirs:
-        if os.path.isdir(dirname) and not os.path.islink(dirname):
-            yield dirname
+    global _standard_dirs_to_mount
+
+    if _standard_dirs_to_mount is None:
+        standard_dirs = (['/home', '/mnt', '/media', '/srv',
+                          '/neurospin', '/drf', '/i2bm', '/nfs']
+                         + glob('/volatile*'))
+        _standard_dirs_to_mount = tuple(
+            dirname for dirname in standard_dirs
+            if os.path.isdir(dirname) and not os.path.islink(dirname))
+    return _standard_dirs_to_mount
 
 
 def prepare_user_config():
@@ -603,10 +741,10 @@ def prepare_user_config():
     except OSError:
         pass  # probably a FileExistsError
     try:
-        with open(user_config_file, 'w') as f:
-            json.dump(auto_generated_config, f,
-                      indent=4, sort_keys=True, separators=(',', ': '))
-            f.write('\n')
+        _write_json_atomic(user_config_file, auto_generated_config,
+                           newline=True,
+                           indent=4, sort_keys=True,
+                           separators=(',', ': '))
     except Exception:
         # give up with a warning, this config file is not essential
         print('Warning: could not create the user configuration file ({0})'
@@ -632,6 +770,43 @@ def mounted_in_container(path, config):
     return False
 
 
+_default_bashrc = r'''
+# .bashrc
+#
+# The default bashrc settings are stored in the Singularity images, so that
+# they can be updated appropriately when the images evolve. Please keep this as
+# the first command of this file.
+. /casa/bashrc
+
+# Users can customize their bash environment below this line. Example
+# customizations are included, please uncomment them to try them out.
+
+# If set, the pattern "**" used in a pathname expansion context will
+# match all files and zero or more directories and subdirectories.
+#shopt -s globstar
+
+# colored GCC warnings and errors
+#export GCC_COLORS='error=01;31:warning=01;35:note=01;36:caret=01;32:locus=01:quote=01'
+
+# Include the current Git branch and Git status in the prompt. VERY USEFUL for
+# developers, but disabled by default because it slows down the prompt on slow
+# filesystems.
+#source /usr/lib/git-core/git-sh-prompt
+#GIT_PS1_SHOWDIRTYSTATE=true
+#GIT_PS1_SHOWSTASHSTATE=true
+#GIT_PS1_SHOWUNTRACKEDFILES=true
+#GIT_PS1_SHOWUPSTREAM=auto
+#GIT_PS1_DESCRIBE_STYLE=describe
+#GIT_PS1_SHOWCOLORHINTS=true
+#PS1='${CASA_ENVIRONMENT:+($CASA_ENVIRONMENT)}\[\033[01;32m\]\u@\h\[\033[00m\]:\[\033[01;34m\]\w\[\033[00m\]\[\033[01m\]$(__git_ps1 " (%s)")\[\033[00m\]\$ '
+
+# Allow quickly changing the current directory to sub-directories of
+# /casa/host, for example:
+#     cd src/axon/master
+#CDPATH=:/casa/host
+''' '\n'  # noqa: E501
+
+
 def prepare_environment_homedir(casa_home_host_path, config):
     """Create or complete a home directory for an environment.
 
@@ -670,41 +845,9 @@ def prepare_environment_homedir(casa_home_host_path, config):
     bashrc = osp.join(casa_home_host_path, '.bashrc')
     if not osp.exists(bashrc):
         with open(bashrc, 'w') as f:
-            print(r'''
-# .bashrc
-#
-# The default bashrc settings are stored in the Singularity images, so that
-# they can be updated appropriately when the images evolve. Please keep this as
-# the first command of this file.
-. /casa/bashrc
-
-# Users can customize their bash environment below this line. Example
-# customizations are included, please uncomment them to try them out.
-
-# If set, the pattern "**" used in a pathname expansion context will
-# match all files and zero or more directories and subdirectories.
-#shopt -s globstar
-
-# colored GCC warnings and errors
-#export GCC_COLORS='error=01;31:warning=01;35:note=01;36:caret=01;32:locus=01:quote=01'
-
-# Include the current Git branch and Git status in the prompt. VERY USEFUL for
-# developers, but disabled by default because it slows down the prompt on slow
-# filesystems.
-#source /usr/lib/git-core/git-sh-prompt
-#GIT_PS1_SHOWDIRTYSTATE=true
-#GIT_PS1_SHOWSTASHSTATE=true
-#GIT_PS1_SHOWUNTRACKEDFILES=true
-#GIT_PS1_SHOWUPSTREAM=auto
-#GIT_PS1_DESCRIBE_STYLE=describe
-#GIT_PS1_SHOWCOLORHINTS=true
-#PS1='${CASA_ENVIRONMENT:+($CASA_ENVIRONMENT)}\[\033[01;32m\]\u@\h\[\033[00m\]:\[\033[01;34m\]\w\[\033[00m\]\[\033[01m\]$(__git_ps1 " (%s)")\[\033[00m\]\$ '
-
-# Allow quickly changing the current directory to sub-directories of
-# /casa/host, for example:
-#     cd src/axon/master
-#CDPATH=:/casa/host
-''', file=f)  # noqa: E501
+            # single write of the module-level template (this runs on
+            # every container start)
+            f.write(_default_bashrc)
     # Create an (empty) .sudo_as_admin_successful file to prevent the startup
     # message telling to use "sudo" in the container, which does not work under
     # Singularity.
@@ -773,8 +916,7 @@ def run_container(config, command, gui, opengl, root, cwd, env, image,
                           eimage)
     cid = config.get('image_id')
     if os.path.exists(eimage + '.json') and cid:
-        with open(eimage + '.json') as f:
-            image_meta = json.load(f)
+        image_meta = _load_json_cached(eimage + '.json')
 
         if cid != image_meta.get('image_id'):
             # check if image_version matches
@@ -803,12 +945,28 @@ def run_container(config, command, gui, opengl, root, cwd, env, image,
                       verbose=verbose)
 
 
+# one test in the verbose output of ctest: the 'Test command:' line,
+# the computed timeout, then the actual command echoed through
+# BRAINVISA_TEST_REMOTE_COMMAND=echo on its own '<n>: ' prefixed line
+_ctest_test_re = re.compile(
+    r': Test command:[^\n]*\n'
+    r'[^\n]*: Test timeout computed to be: (?P<timeout>[^\n]*)\n'
+    r'[^\n]*?: (?P<command>[^\n]*)')
+
+# separator line between test outputs in the logs
+_log_separator = '=' * 80
+
+
 class BBIDaily:
-    def __init__(self, base_directory, jenkins=None):
+    def __init__(self, base_directory, jenkins=None, test_jobs=1):
         # This environment variable must be set by the caller of BBIDaily, to
         # ensure that all recursively called instances of casa_distro will use
         # the correct base_directory.
         assert os.environ['CASA_BASE_DIRECTORY'] == base_directory
+        # number of test labels whose commands are run concurrently by
+        # tests() (each one is a chain of casa_distro subprocess calls)
+        self.test_jobs = test_jobs
+        self._log_lock = threading.Lock()
         self.bbe_name = 'BBE-{0}-{1}'.format(getpass.getuser(),
                                              socket.gethostname())
         self.casa_distro_src = osp.dirname(osp.dirname(
@@ -820,65 +978,168 @@ class BBIDaily:
         self.casa_distro_cmd = [sys.executable, casa_distro]
         self.casa_distro_admin_cmd = [sys.executable, casa_distro_admin]
         self.jenkins = jenkins
+        self._log_queue = None
+        self._known_jenkins_jobs = set()
         if self.jenkins:
-            if not self.jenkins.job_exists(self.bbe_name):
-                self.jenkins.create_job(self.bbe_name)
+            self._ensure_jenkins_job(self.bbe_name)
+            # Jenkins posts are drained by a background thread so that
+            # the build/test pipeline never blocks on network latency.
+            # flush_logs() must be called before the process exits.
+            self._log_queue = queue.Queue()
+            drain = threading.Thread(target=self._drain_log_queue,
+                                     daemon=True)
+            drain.start()
+
+    def _ensure_jenkins_job(self, environment, **config):
+        '''
+        Create the Jenkins job of an environment when it does not
+        exist yet. Jobs seen once are remembered for the lifetime of
+        the instance, so each environment costs at most one HTTP
+        round-trip per daily run instead of one per task.
+        '''
+        if self.jenkins and environment not in self._known_jenkins_jobs:
+            if not self.jenkins.job_exists(environment):
+                self.jenkins.create_job(environment, **config)
+            self._known_jenkins_jobs.add(environment)
+
+    def _drain_log_queue(self):
+        while True:
+            item = self._log_queue.get()
+            try:
+                self.jenkins.create_build(**item)
+            except Exception:
+                # never kill the drain thread, report and go on
+                traceback.print_exc()
+            finally:
+                self._log_queue.task_done()
+
+    def flush_logs(self):
+        '''
+        Wait until every queued Jenkins log post has been sent.
+        '''
+        if self._log_queue is not None:
+            self._log_queue.join()
 
     def log(self, environment, task_name, result, log,
             duration=None):
         if self.jenkins:
-            self.jenkins.create_build(environment=environment,
-                                      task=task_name,
-                                      result=result,
-                                      log=log+'\n',
-                                      duration=duration)
+            self._log_queue.put(dict(environment=environment,
+                                     task=task_name,
+                                     result=result,
+                                     log=log+'\n',
+                                     duration=duration))
         else:
             name = '{0}:{1}'.format(environment, task_name)
-            print()
-            print('  /-' + '-' * len(name) + '-/')
-            print(' / ' + name + ' /')
-            print('/-' + '-' * len(name) + '-/')
-            print()
-            print(log)
+            # logs of concurrently running tests must not interleave
+            with self._log_lock:
+                print()
+                print('  /-' + '-' * len(name) + '-/')
+                print(' / ' + name + ' /')
+                print('/-' + '-' * len(name) + '-/')
+                print()
+                print(log)
 
     def call_output(self, args, **kwargs):
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT, bufsize=-1,
-                             **kwargs)
-        output, nothing = p.communicate()
-        output = six.ensure_str(output,
-                                encoding=locale.getpreferredencoding(),
-                                errors='backslashreplace')
+        # errors= implies text mode, the output is decoded with the
+        # locale encoding as before. It is read line by line as the
+        # subprocess produces it, so that a long bv_maker or ctest log
+        # is not buffered a second time by communicate() before being
+        # joined.
         log = ['-'*40,
-               '$ ' + ' '.join(shlex_quote(six.ensure_str(arg))
-                               for arg in args),
-               '-'*40,
-               output]
+               '$ ' + ' '.join(shlex_quote(arg) for arg in args),
+               '-'*40]
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, bufsize=1,
+                             errors='backslashreplace', **kwargs)
+        with p.stdout:
+            log.extend(line.rstrip('\n') for line in p.stdout)
+        returncode = p.wait()
 
-        return p.returncode, '\n'.join(log)
+        return returncode, '\n'.join(log)
 
     def update_casa_distro(self):
-        start = time.time()
+        '''
+        Update the casa_distro source tree with git pull. The tip of
+        the tracked upstream branch is probed first with git ls-remote
+        and the pull is skipped when it matches the local HEAD, so
+        that a daily run on a quiet day costs a single network
+        round-trip and no restart.
+        Return a (success, updated) pair: updated is True when a pull
+        actually ran, telling the caller that a restart is needed.
+        '''
+        start = time.monotonic_ns()
+        try:
+            local = subprocess.check_output(
+                ['git', '-C', self.casa_distro_src, 'rev-parse', 'HEAD'],
+                universal_newlines=True,
+                stderr=subprocess.DEVNULL).strip()
+            # the upstream of the current branch (e.g. origin/master),
+            # which is what git pull actually updates -- probing the
+            # remote default branch HEAD instead could falsely report
+            # an up-to-date tree on a checkout tracking another branch
+            upstream = subprocess.check_output(
+                ['git', '-C', self.casa_distro_src, 'rev-parse',
+                 '--abbrev-ref', '--symbolic-full-name', '@{u}'],
+                universal_newlines=True,
+                stderr=subprocess.DEVNULL).strip()
+            remote_name, _, remote_branch = upstream.partition('/')
+            remote = subprocess.check_output(
+                ['git', '-C', self.casa_distro_src, 'ls-remote',
+                 remote_name, 'refs/heads/' + remote_branch],
+                universal_newlines=True,
+                stderr=subprocess.DEVNULL).split(None, 1)[0]
+        except (subprocess.CalledProcessError, IndexError):
+            # no upstream, no network... let git pull report the problem
+            local = remote = upstream = None
+        if local is not None and local == remote:
+            duration = (time.monotonic_ns() - start) // 1000000
+            self.log(self.bbe_name, 'update casa_distro', 0,
+                     'casa_distro is up to date with {0} ({1}), '
+                     'git pull skipped'.format(upstream, local),
+                     duration=duration)
+            return True, False
         result, log = self.call_output(['git',
                                         '-C', self.casa_distro_src,
                                         'pull'])
-        duration = int(1000 * (time.time() - start))
+        duration = (time.monotonic_ns() - start) // 1000000
         self.log(self.bbe_name, 'update casa_distro',
                  result, log,
                  duration=duration)
-        return result == 0
+        return result == 0, result == 0
 
     def update_base_images(self, images):
-        start = time.time()
+        start = time.monotonic_ns()
+
+        def pull_one(image):
+            return self.call_output(self.casa_distro_cmd + [
+                'pull_image', 'image={0}'.format(image)])
+
+        images = list(images)
         log = []
         result = None
-        for image in images:
-            result, output = self.call_output(self.casa_distro_cmd + [
-                'pull_image', 'image={0}'.format(image)])
-            log.append(output)
-            if result:
-                break
-        duration = int(1000 * (time.time() - start))
+        if len(images) > 1:
+            # each pull is an independent download, run a few of them
+            # concurrently (the registry bandwidth is the natural
+            # limiter, a large pool would not help). Logs are
+            # collected in submission order and the remaining pulls
+            # are cancelled on the first failure, as before.
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(4, len(images))) \
+                    as pool:
+                futures = [pool.submit(pull_one, image)
+                           for image in images]
+                for future in futures:
+                    result, output = future.result()
+                    log.append(output)
+                    if result:
+                        for remaining in futures:
+                            remaining.cancel()
+                        break
+        else:
+            for image in images:
+                result, output = pull_one(image)
+                log.append(output)
+        duration = (time.monotonic_ns() - start) // 1000000
         self.log(self.bbe_name,
                  'update images',
                  result, '\n'.join(log),
@@ -887,21 +1148,18 @@ class BBIDaily:
 
     def bv_maker(self, config, steps):
         environment = config['name']
-        if self.jenkins:
-            if not self.jenkins.job_exists(environment):
-                self.jenkins.create_job(environment,
-                                        **config)
+        self._ensure_jenkins_job(environment, **config)
         done = []
         failed = []
         for step in steps:
-            start = time.time()
+            start = time.monotonic_ns()
             result, log = self.call_output(self.casa_distro_cmd + [
                 'bv_maker',
                 'name={0}'.format(config['name']),
                 '--',
                 step,
             ])
-            duration = int(1000 * (time.time() - start))
+            duration = (time.monotonic_ns() - start) // 1000000
             self.log(environment, step, result, log, duration=duration)
             if result:
                 failed.append(step)
@@ -912,19 +1170,17 @@ class BBIDaily:
 
     def tests(self, test_config, dev_config):
         environment = test_config['name']
-        if self.jenkins:
-            if not self.jenkins.job_exists(environment):
-                self.jenkins.create_job(environment,
-                                        **test_config)
+        self._ensure_jenkins_job(environment, **test_config)
         # get test commands dict, and log it in the test config log (which may
         # be the dev log or the user image log)
         tests = self.get_test_commands(dev_config,
                                        log_config_name=test_config['name'])
         successful_tests = []
         failed_tests = []
-        for test, commands in tests.items():
+
+        def run_test(test, commands):
             log = []
-            start = time.time()
+            start = time.monotonic_ns()
             success = True
             for command in commands:
                 if test_config['type'] in ('run', 'user'):
@@ -938,9 +1194,9 @@ class BBIDaily:
                     '--',
                     'sh', '-c', command
                 ])
-                log.append('=' * 80)
+                log.append(_log_separator)
                 log.append(output)
-                log.append('=' * 80)
+                log.append(_log_separator)
                 if result:
                     success = False
                     if result in (124, 128+9):
@@ -950,9 +1206,22 @@ class BBIDaily:
                                    .format(result))
                 else:
                     log.append('SUCCESS (exit code {0})'.format(result))
-            duration = int(1000 * (time.time() - start))
+            duration = (time.monotonic_ns() - start) // 1000000
             self.log(environment, test, (0 if success else 1),
                      '\n'.join(log), duration=duration)
+            return success
+
+        if self.test_jobs > 1 and len(tests) > 1:
+            # the tests of different labels are independent subprocess
+            # chains, run them concurrently
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.test_jobs) as pool:
+                results = list(pool.map(lambda item: run_test(*item),
+                                        tests.items()))
+        else:
+            results = [run_test(test, commands)
+                       for test, commands in tests.items()]
+        for test, success in zip(tests, results):
             if success:
                 successful_tests.append(test)
             else:
@@ -963,12 +1232,81 @@ class BBIDaily:
                          ', '.join(failed_tests)))
         return (successful_tests, failed_tests)
 
+    @staticmethod
+    def _parse_ctest_commands(o):
+        '''
+        Extract the test commands from the verbose output of a
+        'ctest -V -L ^label$' run, given as a list of lines. Commands
+        whose ctest timeout is finite are wrapped in 'timeout -k 10'.
+        '''
+        # Each test appears as a 'Test command:' line (the actual
+        # command wrapped in BRAINVISA_TEST_REMOTE_COMMAND), followed
+        # by the timeout line and by the command echoed on its own
+        # line. One pass of the compiled regex extracts both.
+        commands = []
+        for m in _ctest_test_re.finditer('\n'.join(o)):
+            command = m.group('command').strip()
+            timeout = m.group('timeout').strip()
+            if float(timeout) < 9.999e+06:
+                command = 'timeout -k 10 %s %s' % (timeout, command)
+            commands.append(command)
+        return commands
+
+    def _ctest_fingerprint(self, config):
+        '''
+        Fingerprint the ctest state of the build tree of a dev
+        environment: the discovered test commands only change when a
+        CTestTestfile.cmake changes (or the ctest options do). Return
+        None when no such file is visible on the host side, in which
+        case caching is disabled.
+        '''
+        ctest_files = sorted(glob(osp.join(
+            config['directory'], 'build', '**', 'CTestTestfile.cmake'),
+            recursive=True))
+        if not ctest_files:
+            return None
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps(
+            config.get('ctest_options', [])).encode())
+        for path in ctest_files:
+            st = os.stat(path)
+            fingerprint.update('{0}\0{1}\0{2}\n'.format(
+                path, st.st_mtime_ns, st.st_size).encode())
+        return fingerprint.hexdigest()
+
     def get_test_commands(self, config, log_config_name=None):
         '''
         Given the config of a dev environment, return a dictionary
         whose keys are name of a test (i.e. 'axon', 'soma', etc.) and
         values are a list of commands to run to perform the test.
+
+        The result is cached in the conf directory of the environment,
+        keyed by a fingerprint of the CTestTestfile.cmake files of the
+        build tree: when the build has not changed since the previous
+        run (e.g. a daily run on a quiet day), the two container
+        launches are skipped entirely. Removing the cache file forces
+        a fresh scan.
         '''
+        if log_config_name is None:
+            log_config_name = config['name']
+        cache_file = osp.join(config['directory'], 'conf',
+                              '.ctest_commands.json')
+        fingerprint = self._ctest_fingerprint(config)
+        if fingerprint is not None and osp.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+            except ValueError:
+                # a corrupt cache must never break the run, rescan
+                cached = {}
+            if cached.get('fingerprint') == fingerprint:
+                tests = cached['tests']
+                self.log(log_config_name, 'get test commands', 0,
+                         'Build tree unchanged, reusing the test commands '
+                         'of the previous run:\n'
+                         + json.dumps(tests, indent=4,
+                                      separators=(',', ': ')))
+                return tests
         cmd = self.casa_distro_cmd + [
             'run',
             'name={0}'.format(config['name']),
@@ -976,30 +1314,42 @@ class BBIDaily:
             '--',
             'ctest', '--print-labels'
         ]
-        # universal_newlines is the old name to request text-mode (text=True)
         o = subprocess.check_output(cmd, bufsize=-1,
-                                    universal_newlines=True)
+                                    errors='backslashreplace')
         labels = [i.strip() for i in o.split('\n')[2:] if i.strip()]
         log_lines = ['$ ' + ' '.join(shlex_quote(arg) for arg in cmd),
                      o, '\n']
         tests = {}
-        for label in labels:
+        if labels:
+            # run ctest for all labels in a single container invocation:
+            # each 'casa_distro run' boots a Python process and a
+            # container, which dominates the cost of the ctest calls
+            # themselves. A sentinel line separates the per-label
+            # outputs so that they can be parsed individually.
+            marker = 'casa_distro_test_label:'
+            ctest_options = ' '.join(shlex_quote(i)
+                                     for i in config.get('ctest_options', []))
+            script = ';'.join(
+                "echo {0};ctest -V -L {1} {2}||exit $?".format(
+                    shlex_quote('{0} {1}'.format(marker, label)),
+                    shlex_quote('^{0}$'.format(label)),
+                    ctest_options)
+                for label in labels)
             cmd = self.casa_distro_cmd + [
                 'run',
                 'name={0}'.format(config['name']),
                 'cwd=/casa/host/build',
                 'env=BRAINVISA_TEST_REMOTE_COMMAND=echo',
                 '--',
-                'ctest', '-V', '-L',
-                '^{0}$'.format(label)
-            ] + config.get('ctest_options', [])
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE, bufsize=-1,
-                                 universal_newlines=True)
-            o, stderr = p.communicate()
+                'sh', '-c', script
+            ]
+            cp = subprocess.run(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, bufsize=-1,
+                                errors='backslashreplace')
+            o, stderr = cp.stdout, cp.stderr
             log_lines += ['$ ' + ' '.join(shlex_quote(arg) for arg in cmd),
                           o, '\n']
-            if p.returncode != 0:
+            if cp.returncode != 0:
                 # We want to hide stderr unless ctest returns a nonzero exit
                 # code. In the case of test filtering where no tests are
                 # matched (e.g. with ctest_options=['-R', 'dummyfilter']), the
@@ -1007,40 +1357,37 @@ class BBIDaily:
                 # stderr by ctest, but it exits with return code 0.
                 sys.stderr.write(stderr)
                 raise RuntimeError('ctest failed with the above error')
-            o = o.split('\n')
-            # Extract the third line that follows each line containing ': Test
-            # command:'
-            commands = [o[i+2][o[i+2].find(':')+2:].strip()
-                        for i in range(len(o))
-                        if ': Test command:' in o[i]]
-            timeouts = [o[i+1][o[i+1].find(':')+2:].strip()
-                        for i in range(len(o))
-                        if ': Test command:' in o[i]]
-            timeouts = [x[x.find(':')+2:] for x in timeouts]
-            if commands:  # skip empty command lists
-                for i, command in enumerate(commands):
-                    if float(timeouts[i]) < 9.999e+06:
-                        command = 'timeout -k 10 %s %s' % (timeouts[i],
-                                                           command)
-                        commands[i] = command
-                tests[label] = commands
+            sections = {}
+            section = None
+            for line in o.split('\n'):
+                if line.startswith(marker):
+                    section = []
+                    sections[line[len(marker):].strip()] = section
+                elif section is not None:
+                    section.append(line)
+            if set(sections) != set(labels):
+                raise RuntimeError(
+                    'could not split the output of ctest by label (got '
+                    '{0!r}, expected {1!r})'.format(sorted(sections),
+                                                    sorted(labels)))
+            for label in labels:
+                commands = self._parse_ctest_commands(sections[label])
+                if commands:  # skip empty command lists
+                    tests[label] = commands
         log_lines += ['Final test dictionary:',
                       json.dumps(tests, indent=4, separators=(',', ': '))]
 
-        if log_config_name is None:
-            log_config_name = config['name']
+        if fingerprint is not None:
+            _write_json_atomic(cache_file, {'fingerprint': fingerprint,
+                                            'tests': tests})
         self.log(log_config_name, 'get test commands', 0, '\n'.join(log_lines))
         return tests
 
     def recreate_user_env(self, user_config, dev_config):
         environment = user_config['name']
-        if self.jenkins:
-            if not self.jenkins.job_exists(environment):
-                self.jenkins.create_job(environment,
-                                        **user_config)
-        start = time.time()
-        if not os.path.exists(user_config['directory']):
-            os.makedirs(user_config['directory'])
+        self._ensure_jenkins_job(environment, **user_config)
+        start = time.monotonic_ns()
+        os.makedirs(user_config['directory'], exist_ok=True)
         eimage = osp.normpath(osp.join(user_config.get('directory'),
                                        user_config['image']))
         result, log = self.call_output([
@@ -1054,33 +1401,81 @@ class BBIDaily:
                                              'tests', 'ref')
             dev_test_ref_dir = os.path.join(dev_config['directory'],
                                             'tests', 'ref')
-            if not os.path.exists(user_test_ref_dir):
-                if not os.path.exists(os.path.dirname(user_test_ref_dir)):
-                    os.makedirs(os.path.dirname(user_test_ref_dir))
+            os.makedirs(os.path.dirname(user_test_ref_dir), exist_ok=True)
+            try:
                 os.symlink(os.path.join('/host', dev_test_ref_dir),
                            user_test_ref_dir)
+            except FileExistsError:
+                pass
 
             for command in (dev_config.get('bbi_user_config', {})
                             .get('setup_commands', [])):
                 subprocess.check_call(command, shell=True,
                                       cwd=user_config['directory'])
-        duration = int(1000 * (time.time() - start))
+        duration = (time.monotonic_ns() - start) // 1000000
         self.log(user_config['name'], 'recreate user env', result, log,
                  duration=duration)
         return result == 0
 
+    def _user_image_fingerprint(self, user_config, dev_config,
+                                install_doc, install_test,
+                                install_thirdparty):
+        '''
+        Fingerprint of the inputs of a user image build: the target
+        version, the install flags, the dev image, and the ctest
+        state of the dev build tree. When it has not changed since
+        the previous successful build, the image does not need to be
+        rebuilt.
+        '''
+        fp = hashlib.blake2b(digest_size=16)
+        for value in (user_config['version'], install_doc, install_test,
+                      install_thirdparty):
+            fp.update(str(value).encode())
+            fp.update(b'\0')
+        dev_image = dev_config.get('image')
+        if dev_image:
+            if not osp.isabs(dev_image):
+                dev_image = osp.normpath(osp.join(dev_config['directory'],
+                                                  dev_image))
+            try:
+                st = os.stat(dev_image)
+            except OSError:
+                pass
+            else:
+                fp.update(b'%d\0%d\0' % (st.st_mtime_ns, st.st_size))
+        ctest_state = self._ctest_fingerprint(dev_config)
+        if ctest_state is not None:
+            fp.update(ctest_state.encode())
+        return fp.hexdigest()
+
     def update_user_image(self, user_config, dev_config,
                           install_doc=True,
                           install_test=True,
                           install_thirdparty='default'):
         environment = user_config['name']
-        if self.jenkins:
-            if not self.jenkins.job_exists(environment):
-                self.jenkins.create_job(environment,
-                                        **user_config)
-        start = time.time()
+        self._ensure_jenkins_job(environment, **user_config)
+        start = time.monotonic_ns()
         image = user_config['image']
         image = osp.normpath(osp.join(user_config.get('directory'), image))
+        # rebuilding the user image is the most expensive daily
+        # operation: skip it when the image exists and was built from
+        # the same inputs (with the default dated version this only
+        # skips same-day reruns, e.g. recovery of a failed nightly)
+        fingerprint = self._user_image_fingerprint(
+            user_config, dev_config, install_doc, install_test,
+            install_thirdparty)
+        fingerprint_file = image + '.fingerprint'
+        if osp.exists(image) and osp.exists(fingerprint_file):
+            with open(fingerprint_file) as f:
+                if f.read().strip() == fingerprint:
+                    duration = (time.monotonic_ns() - start) // 1000000
+                    self.log(user_config['name'], 'update user image', 0,
+                             'user image inputs unchanged, '
+                             'rebuild skipped: ' + image,
+                             duration=duration)
+                    return True
+        if osp.exists(fingerprint_file):
+            os.remove(fingerprint_file)
         if osp.exists(image):
             os.remove(image)
         result, log = self.call_output(self.casa_distro_admin_cmd + [
@@ -1094,7 +1489,10 @@ class BBIDaily:
             'install_doc=' + str(install_doc),
             'install_test=' + str(install_test),
         ])
-        duration = int(1000 * (time.time() - start))
+        if result == 0:
+            with open(fingerprint_file, 'w') as f:
+                f.write(fingerprint + '\n')
+        duration = (time.monotonic_ns() - start) // 1000000
         self.log(user_config['name'], 'update user image', result, log,
                  duration=duration)
         return result == 0
@@ -5,15 +5,42 @@ import hashlib
 import os
 
 
-def file_hash(path, blocksize=2**20):
+# MD5 is kept (not upgraded to SHA-2) because the hashes are compared
+# with the "md5" key of metadata published on the download server.
+def _md5_fileobj(f, blocksize):
+    if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+        return hashlib.file_digest(f, hashlib.md5)
+    # zero-copy read loop for older Python versions
     m = hashlib.md5()
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        m.update(view[:n])
+    return m
+
+
+def file_hash(path, blocksize=2**20):
+    with open(path, 'rb') as f:
+        return _md5_fileobj(f, blocksize).hexdigest()
+
+
+def file_size_and_hash(path, blocksize=2**20):
+    '''
+    Return (size, md5 hex digest) of a file, reading it only once. The
+    kernel is advised of the sequential read, so an upload of the same
+    file right after (e.g. rsync in the publish commands) starts from a
+    warm page cache.
+    '''
+    size = os.stat(path).st_size
     with open(path, 'rb') as f:
-        while True:
-            buf = f.read(blocksize)
-            if not buf:
-                break
-            m.update(buf)
-    return m.hexdigest()
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass  # not available on every platform
+        return size, _md5_fileobj(f, blocksize).hexdigest()
 
 
 def check_hash(path, md5_file):
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 
+import hashlib
 import json
 import os
 import os.path as osp
@@ -9,6 +10,39 @@ import sys
 import tempfile
 
 
+CASA_DISTRO_TREE_DIRS = ('bin', 'cbin', 'python', 'etc', 'share')
+"""Directories of the casa-distro source tree that are installed in
+images (see install_casa_distro in the builders)."""
+
+
+def source_tree_hash(directory, dirs=CASA_DISTRO_TREE_DIRS):
+    '''
+    Return a SHA-256 hex digest identifying the content of the given
+    casa-distro source tree. The hash covers sorted relative file paths
+    and file contents (symlinks hash their target), ignoring compiled
+    and backup files, so it is stable across checkouts of identical
+    content.
+    '''
+    tree_hash = hashlib.sha256()
+    for d in dirs:
+        base = osp.join(directory, d)
+        for root, subdirs, files in os.walk(base):
+            subdirs[:] = sorted(s for s in subdirs if s != '__pycache__')
+            for f in sorted(files):
+                if f.endswith(('.pyc', '~')):
+                    continue
+                path = osp.join(root, f)
+                tree_hash.update(osp.relpath(path, directory).encode())
+                if osp.islink(path):
+                    tree_hash.update(os.readlink(path).encode())
+                else:
+                    with open(path, 'rb') as fobj:
+                        for chunk in iter(lambda: fobj.read(1024 * 1024),
+                                          b''):
+                            tree_hash.update(chunk)
+    return tree_hash.hexdigest()
+
+
 class LocalInstaller:
     '''
     class to run locally commands provided by an image builder
@@ -23,7 +57,8 @@ class LocalInstaller:
         if not osp.exists(self.log_file):
             self.log = {}
         else:
-            self.log = json.load(open(self.log_file))
+            with open(self.log_file) as f:
+                self.log = json.load(f)
 
     def run_user(self, command):
         '''
@@ -37,17 +72,58 @@ class LocalInstaller:
         '''
         subprocess.check_call(['sh', '-c', 'umask 0022 && ' + command])
 
-    def copy_root(self, source_file, dest_dir):
+    def copy_root(self, source_file, dest_dir, mode=None):
         '''
         Copy a file as root
         '''
-        self.run_root("cp -r '{}' '{}'".format(source_file, dest_dir))
+        command = "cp -r '{}' '{}'".format(source_file, dest_dir)
+        if mode is not None:
+            command += " && chmod {:o} '{}/{}'".format(
+                mode, dest_dir, osp.basename(source_file))
+        self.run_root(command)
 
-    def copy_user(self, source, dest_dir):
+    def copy_user(self, source, dest_dir, mode=None):
         '''
         Copy a file or a directory as self.user
         '''
-        self.run_user("cp -r '{}' '{}'".format(source, dest_dir))
+        command = "cp -r '{}' '{}'".format(source, dest_dir)
+        if mode is not None:
+            command += " && chmod {:o} '{}/{}'".format(
+                mode, dest_dir, osp.basename(source))
+        self.run_user(command)
+
+    def copy_root_many(self, source_files, dest_dir, mode=None):
+        '''
+        Copy several files as root with a single copy command
+        '''
+        command = "cp -r {} '{}'".format(
+            ' '.join("'{}'".format(f) for f in source_files), dest_dir)
+        if mode is not None:
+            command += " && chmod {:o} {}".format(
+                mode, ' '.join("'{}/{}'".format(dest_dir, osp.basename(f))
+                               for f in source_files))
+        self.run_root(command)
+
+    def install_casa_distro(self, dest):
+        '''
+        Copy the casa-distro source tree into dest. The copy is skipped
+        when the content hash recorded in dest/.stamp matches the
+        current source tree, making repeated installs a no-op.
+        '''
+        source = osp.dirname(osp.dirname(osp.dirname(__file__)))
+        tree_hash = source_tree_hash(source)
+        stamp_file = osp.join(dest, '.stamp')
+        if osp.exists(stamp_file):
+            with open(stamp_file) as f:
+                if f.read().strip() == tree_hash:
+                    return
+        self.run_root("if [ ! -d '{0}' ]; then mkdir -p '{0}'; fi"
+                      .format(dest))
+        for i in CASA_DISTRO_TREE_DIRS:
+            self.copy_root(osp.join(source, i), dest)
+        self.run_root(("find %s -name __pycache__ -o -name '*\\.pyc' "
+                       "-o -name '*~' -exec rm -Rf '{}' \\;") % dest)
+        self.run_root("echo {} > '{}'".format(tree_hash, stamp_file))
 
     def perform_step(self, build_file, step_name):
         '''
@@ -57,7 +133,7 @@ class LocalInstaller:
             raise SystemError('This command must be executed as root')
 
         builder = get_image_builder(build_file)
-        for step in builder.steps:
+        for step in builder.ordered_steps():
             if step.__name__ == step_name:
                 break
         else:
@@ -71,13 +147,15 @@ class LocalInstaller:
         sys.stderr = sys.stdout = log
         try:
             step(osp.dirname(build_file), self)
-            self.log.setdefault(builder.name, {})[step.__name__] = \
-                {'output': open(log.name, 'r').read()}
+            with open(log.name, 'r') as f:
+                self.log.setdefault(builder.name, {})[step.__name__] = \
+                    {'output': f.read()}
         finally:
             sys.stderr = stderr
             sys.stdout = stdout
             log.flush()
-            json.dump(self.log, open(self.log_file, 'w'))
+            with open(self.log_file, 'w') as f:
+                json.dump(self.log, f)
 
 
 def get_image_builder(build_file):
@@ -118,6 +196,8 @@ class ImageBuilder:
             copy_root(source_file, dest_dir, preserve_symlinks=True,
                       preserve_ext_symlinks=True):
                 copy files as root.
+            copy_root_many(source_files, dest_dir):
+                copy several files as root in a single batched copy.
             symlink(target, link_name): create a symlink in the target
                 environment.
             environment(environment_dict): set environment variables values
@@ -131,7 +211,68 @@ class ImageBuilder:
         self.name = name
         self.base = base
         self.steps = []
+        self.step_dependencies = {}
         self.build_dir = None  # set later by get image_builder
 
-    def step(self, step_function):
+    def step(self, step_function=None, depends_on=None):
+        '''
+        Register an installation step. May be used as a plain decorator
+        or with a ``depends_on`` argument naming steps that must be
+        performed first::
+
+            @builder.step
+            def copy_files(base_dir, builder): ...
+
+            @builder.step(depends_on=['copy_files'])
+            def install(base_dir, builder): ...
+
+        Steps are always executed sequentially because recipe builders
+        emit shell sections whose order matters, but the dependency
+        graph makes ordering constraints explicit: ordered_steps()
+        returns the steps in a topological order that is checked for
+        unknown or cyclic dependencies.
+        '''
+        if step_function is None:
+            def decorator(step_function):
+                return self.step(step_function, depends_on=depends_on)
+            return decorator
         self.steps.append(step_function)
+        self.step_dependencies[step_function.__name__] \
+            = list(depends_on or ())
+        return step_function
+
+    def ordered_steps(self):
+        '''
+        Return the steps sorted so that declared dependencies are
+        performed first. The sort is stable: declaration order is
+        preserved among independent steps. Raise a ValueError for
+        unknown or cyclic dependencies.
+        '''
+        step_names = set(s.__name__ for s in self.steps)
+        for step_name, deps in self.step_dependencies.items():
+            unknown = [d for d in deps if d not in step_names]
+            if unknown:
+                raise ValueError(
+                    'Step "{0}" of image builder "{1}" depends on unknown '
+                    'step(s): {2}'.format(step_name, self.name,
+                                          ', '.join(unknown)))
+        result = []
+        done = set()
+        remaining = self.steps
+        while remaining:
+            still_waiting = []
+            for step in remaining:
+                if all(d in done
+                       for d in self.step_dependencies[step.__name__]):
+                    result.append(step)
+                    done.add(step.__name__)
+                else:
+                    still_waiting.append(step)
+            if len(still_waiting) == len(remaining):
+                raise ValueError(
+                    'Cyclic dependencies between steps of image builder '
+                    '"{0}": {1}'.format(
+                        self.name,
+                        ', '.join(s.__name__ for s in still_waiting)))
+            remaining = still_waiting
+        return result
@@ -6,7 +6,9 @@ from xml.sax.saxutils import escape as xmlescape
 
 
 import requests
-import six
+from requests.adapters import HTTPAdapter
+
+from casa_distro import six
 
 
 class BrainVISAJenkins:
@@ -49,24 +51,32 @@ class BrainVISAJenkins:
         self.server = server
         self.login = login
         self.password = password
+        # A nightly build posts many small requests: a pooled session
+        # reuses one TCP+TLS connection instead of paying a handshake
+        # per call, and retries transient connection failures.
+        self.session = requests.Session()
+        self.session.auth = (login, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                              max_retries=3)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def get(self, route, **kwargs):
-        return requests.get('{0}/{1}'.format(self.server, route),
-                            auth=(self.login, self.password),
-                            **kwargs)
+        return self.session.get('{0}/{1}'.format(self.server, route),
+                                **kwargs)
 
     def post(self, route, **kwargs):
-        return requests.post('{0}/{1}'.format(self.server, route),
-                             auth=(self.login, self.password),
-                             **kwargs)
+        return self.session.post('{0}/{1}'.format(self.server, route),
+                                 **kwargs)
 
     def delete(self, route, **kwargs):
-        return requests.delete('{0}/{1}'.format(self.server, route),
-                               auth=(self.login, self.password),
-                               **kwargs)
+        return self.session.delete('{0}/{1}'.format(self.server, route),
+                                   **kwargs)
 
     def job_exists(self, environment):
-        r = self.get('/job/{0}/api/json'.format(environment))
+        # tree= restricts the response to the fields we actually use
+        r = self.get('/job/{0}/api/json'.format(environment),
+                     params={'tree': 'name'})
         if r.status_code == 404:
             return False
         r.raise_for_status()
@@ -97,7 +107,7 @@ class BrainVISAJenkins:
         r.raise_for_status()
 
     def jobs(self):
-        r = self.get('api/json')
+        r = self.get('api/json', params={'tree': 'jobs[name]'})
         r.raise_for_status()
         return [i['name'] for i in r.json()['jobs']]
 
@@ -3,11 +3,8 @@
 from __future__ import absolute_import, division, print_function
 
 import io
-import types
 import sys
 
-from casa_distro import six
-
 
 def boolean_value(value):
     '''
@@ -18,7 +15,7 @@ def boolean_value(value):
     '''
     if isinstance(value, (int, bool)):
         return bool(value)
-    elif isinstance(value, six.string_types):
+    elif isinstance(value, str):
         value = value.lower()
         if value in ('true', 'yes', '1'):
             return True
@@ -31,15 +28,14 @@ def verbose_file(verbose, openmode='w+'):
     verbose = boolean_value(verbose)
     if verbose is not None:
         return (sys.stdout if verbose else None)
-    if isinstance(verbose, six.string_types):
+    if isinstance(verbose, str):
         # Try to open file from given string
         try:
             verbose = open(verbose, openmode)
         except IOError:
             return None
 
-    if (isinstance(verbose, io.IOBase)
-            or six.PY2 and isinstance(verbose, types.FileType)):
+    if isinstance(verbose, io.IOBase):
         return verbose
 
     return None
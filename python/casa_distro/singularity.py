@@ -17,6 +17,7 @@ import shlex
 from . import six
 from .log import boolean_value
 from casa_distro.defaults import default_base_directory
+from .image_builder import CASA_DISTRO_TREE_DIRS, source_tree_hash
 from .thirdparty import install_thirdparty_software
 
 try:
@@ -62,7 +63,7 @@ class RecipeBuilder:
         self.sections.setdefault('post', []).append(command)
 
     def copy_root(self, source_file, dest_dir, preserve_symlinks=True,
-                  preserve_ext_symlinks=True):
+                  preserve_ext_symlinks=True, mode=None):
         '''
         Copy a file in VM as root
 
@@ -82,6 +83,9 @@ class RecipeBuilder:
             If False: Copy symbolic links as symlinks only if they point inside
             the source tree. Otherwise replace them with the pointed file.
             The ``rsync`` command is used to perform this.
+        mode: int
+            If given, set the permissions of the copied file (octal mode,
+            e.g. 0o755), avoiding a separate chmod command.
         '''
         if not preserve_symlinks:
             # this variant is safer
@@ -114,6 +118,38 @@ class RecipeBuilder:
                     % (osp.realpath(source_file),
                        '${SINGULARITY_ROOTFS}/%s/%s'
                        % (dest_dir, osp.basename(source_file))))
+        if mode is not None:
+            self.run_root('chmod %o %s/%s'
+                          % (mode, dest_dir, osp.basename(source_file)))
+
+    def copy_root_many(self, source_files, dest_dir, mode=None):
+        '''
+        Copy several files in VM as root, with a single copy command for
+        the whole batch.
+
+        Symbolic links are preserved (as with copy_root default options).
+        Sources whose real path does not keep the same base name are
+        copied individually via copy_root.
+        '''
+        batch = []
+        for source_file in source_files:
+            real = osp.realpath(source_file)
+            if osp.basename(real) == osp.basename(source_file):
+                batch.append(real)
+            else:
+                self.copy_root(source_file, dest_dir)
+        if batch:
+            self.sections.setdefault('setup', []).append(
+                'if [ ! -d ${SINGULARITY_ROOTFS}/' + dest_dir + ' ]; then '
+                'mkdir -p ${SINGULARITY_ROOTFS}/' + dest_dir + '; fi')
+            self.sections.setdefault('setup', []).append(
+                'cp -a %s ${SINGULARITY_ROOTFS}/%s/'
+                % (' '.join(batch), dest_dir))
+        if mode is not None:
+            self.run_root('chmod %o %s' % (
+                mode,
+                ' '.join(dest_dir + '/' + osp.basename(f)
+                         for f in source_files)))
 
     def extract_tar(self, source_file, dest_dir):
         ''' Extract a tar archive into the dest directory
@@ -139,7 +175,7 @@ class RecipeBuilder:
         )
 
     def copy_user(self, source_file, dest_dir, preserve_symlinks=True,
-                  preserve_ext_symlinks=True):
+                  preserve_ext_symlinks=True, mode=None):
         '''
         Copy a file in VM as root
 
@@ -159,6 +195,9 @@ class RecipeBuilder:
             If False: Copy symbolic links as symlinks only if they point inside
             the source tree. Otherwise replace them with the pointed file.
             The ``rsync`` command is used to perform this.
+        mode: int
+            If given, set the permissions of the copied file (octal mode,
+            e.g. 0o755), avoiding a separate chmod command.
         '''
         if not preserve_symlinks:
             # this variant is safer
@@ -181,6 +220,9 @@ class RecipeBuilder:
                 self.sections.setdefault('setup', []).append(
                     'cp -a %s %s'
                     % (source_file, '${SINGULARITY_ROOTFS}/' + dest_dir + '/'))
+        if mode is not None:
+            self.run_user('chmod %o %s/%s'
+                          % (mode, dest_dir, osp.basename(source_file)))
 
     def environment(self, environment_dict):
         for variable, value in environment_dict.items():
@@ -197,13 +239,19 @@ class RecipeBuilder:
 
     def install_casa_distro(self, dest):
         source = osp.dirname(osp.dirname(osp.dirname(__file__)))
-        for i in ('bin', 'cbin', 'python', 'etc', 'share'):
+        for i in CASA_DISTRO_TREE_DIRS:
             self.copy_root(osp.join(source, i), dest)
         self.run_root(("find %s -name __pycache__ -o -name '*\\.pyc' "
                        "-o -name '*~' -exec rm -Rf '{}' \\;") % dest)
+        # Record a content hash of the installed tree so that later
+        # installs (e.g. local_install) can skip the copy when nothing
+        # changed.
+        self.run_root('echo %s > %s/.stamp'
+                      % (source_tree_hash(source), dest))
 
 
-def _singularity_build_command(cleanup=True, force=False, fakeroot=True):
+def _singularity_build_command(cleanup=True, force=False, fakeroot=True,
+                               cachedir=None):
     build_command = []
     if not fakeroot:
         build_command += ['sudo']
@@ -215,7 +263,12 @@ def _singularity_build_command(cleanup=True, force=False, fakeroot=True):
                               + os.environ['APPTAINER_TMPDIR']]
         if 'TMPDIR' in os.environ:
             build_command += ['TMPDIR=' + os.environ['TMPDIR']]
-    build_command += [singularity_executable(), 'build', '--disable-cache']
+        if cachedir:
+            build_command += ['SINGULARITY_CACHEDIR=' + cachedir,
+                              'APPTAINER_CACHEDIR=' + cachedir]
+    build_command += [singularity_executable(), 'build']
+    if not cachedir:
+        build_command.append('--disable-cache')
     if fakeroot:
         build_command += ['--fakeroot']
     if not cleanup:
@@ -225,12 +278,26 @@ def _singularity_build_command(cleanup=True, force=False, fakeroot=True):
     return build_command
 
 
+def _singularity_build_env(cachedir=None):
+    '''
+    Environment to use for a singularity build command, pointing the
+    Singularity/Apptainer cache to cachedir when it is given.
+    '''
+    if not cachedir:
+        return None
+    build_env = os.environ.copy()
+    build_env['SINGULARITY_CACHEDIR'] = cachedir
+    build_env['APPTAINER_CACHEDIR'] = cachedir
+    return build_env
+
+
 def create_image(base, base_metadata,
                  output, metadata,
                  image_builder,
                  cleanup='yes',
                  force='no',
                  fakeroot='yes',
+                 cachedir=None,
                  verbose=None):
     '''
     Returns
@@ -302,7 +369,7 @@ Bootstrap: localimage
 
         installer = RecipeBuilder(output)
         installer.image_version = metadata['image_version']
-        for step in image_builder.steps:
+        for step in image_builder.ordered_steps():
             if verbose:
                 print('Performing:', step.__doc__, file=verbose)
             step(base_dir=image_builder.build_dir,
@@ -315,7 +382,8 @@ Bootstrap: localimage
             verbose.flush()
         build_command = _singularity_build_command(cleanup=cleanup,
                                                    force=force,
-                                                   fakeroot=fakeroot)
+                                                   fakeroot=fakeroot,
+                                                   cachedir=cachedir)
         if verbose:
             print('run create command:\n',
                   *(build_command + [output, recipe.name]))
@@ -323,7 +391,8 @@ Bootstrap: localimage
         # permission issue with --fakeroot and NFS root_squash.
         try:
             subprocess.check_call(build_command + [output, recipe.name],
-                                  cwd='/')
+                                  cwd='/',
+                                  env=_singularity_build_env(cachedir))
         except Exception:
             if fakeroot:
                 print('** Image creation has failed **', file=sys.stderr)
@@ -348,7 +417,8 @@ def create_user_image(base_image,
                       base_directory=default_base_directory,
                       verbose=None,
                       install_thirdparty='all',
-                      cleanup=True):
+                      cleanup=True,
+                      cachedir=None):
     '''
     Returns
     -------
@@ -439,12 +509,14 @@ Bootstrap: localimage
             verbose.flush()
         build_command = _singularity_build_command(force=force,
                                                    fakeroot=fakeroot,
-                                                   cleanup=cleanup)
+                                                   cleanup=cleanup,
+                                                   cachedir=cachedir)
         # Set cwd to a directory that root is allowed to 'cd' into, to avoid a
         # permission issue with --fakeroot and NFS root_squash.
         try:
             subprocess.check_call(build_command + [output, recipe.name],
-                                  cwd='/')
+                                  cwd='/',
+                                  env=_singularity_build_env(cachedir))
         except Exception:
             if fakeroot:
                 print('** Image creation has failed **', file=sys.stderr)
@@ -6,7 +6,6 @@ import os
 import os.path as osp
 import sys
 
-from casa_distro import six
 from casa_distro.command import command, check_boolean
 from casa_distro.defaults import default_download_url
 from casa_distro.environment import (casa_distro_directory,
@@ -49,7 +48,7 @@ def display_summary(status):
 
     global_failed = False
     first_start = None
-    for (d, b, s, iv), (es, bwf_dir) in six.iteritems(status):
+    for (d, b, s, iv), (es, bwf_dir) in status.items():
         status = es.get_status_mapped()
         if status != '':
             message = '%s distro=%s branch=%s system=%s image_version=%s: %s' \
@@ -521,6 +520,7 @@ def mrun(type=None, distro=None, branch=None, system=None,
          env=None,
          image=None,
          container_options=[],
+         jobs='1',
          args_list=[],
          verbose=None):
     '''
@@ -550,6 +550,13 @@ def mrun(type=None, distro=None, branch=None, system=None,
     {env}
     {image}
     {container_options}
+    jobs
+        default = {jobs_default}
+        Number of environments to run concurrently. Each selected
+        environment uses its own container and build directory, so
+        they are independent; with jobs > 1 their output is
+        interleaved on the terminal. Useful for non-interactive
+        commands such as ``bv_maker``.
     {verbose}
 
     '''
@@ -567,28 +574,37 @@ def mrun(type=None, distro=None, branch=None, system=None,
             raise ValueError('env syntax error. Should be in the shape '
                              '"VAR1=value1,VAR2=value2" etc.')
     command = args_list
-    res = []
-
-    for config in iter_environments(base_directory,
-                                    type=type,
-                                    distro=distro,
-                                    branch=branch,
-                                    system=system,
-                                    image_version=image_version,
-                                    name=name,
-                                    version=version):
-
-        res.append(run_container(config,
-                                 command=command,
-                                 gui=gui,
-                                 opengl=opengl,
-                                 root=root,
-                                 cwd=cwd,
-                                 env=env,
-                                 image=image,
-                                 container_options=container_options,
-                                 base_directory=base_directory,
-                                 verbose=verbose))
+    jobs = int(jobs)
+
+    def run_one(config):
+        return run_container(config,
+                             command=command,
+                             gui=gui,
+                             opengl=opengl,
+                             root=root,
+                             cwd=cwd,
+                             env=env,
+                             image=image,
+                             container_options=container_options,
+                             base_directory=base_directory,
+                             verbose=verbose)
+
+    configs = list(iter_environments(base_directory,
+                                     type=type,
+                                     distro=distro,
+                                     branch=branch,
+                                     system=system,
+                                     image_version=image_version,
+                                     name=name,
+                                     version=version))
+    if jobs > 1 and len(configs) > 1:
+        # containers are independent and the work is subprocess-bound,
+        # threads are enough to run them concurrently
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            res = list(pool.map(run_one, configs))
+    else:
+        res = [run_one(config) for config in configs]
 
     if all(r == 0 for r in res):
         return 0
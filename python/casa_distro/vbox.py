@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
 
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import os
 import os.path as osp
@@ -82,9 +83,11 @@ def create_image(base, base_metadata,
                  disk_size='131072',
                  gui='no',
                  cleanup='yes',
+                 jobs='1',
                  verbose=None):
 
     gui = boolean_value(gui)
+    jobs = int(jobs)
     type = metadata['type']
     name = metadata['name']
     vdi = output[:-3] + 'vdi'
@@ -212,13 +215,13 @@ def create_image(base, base_metadata,
         if base:
             vbox_import_image(base, name,
                               verbose=verbose)
-        vbox = VBoxMachine(name)
+        vbox = VBoxMachine(name, jobs=jobs)
         vbox.image_version = metadata['image_version']
         vbox.install(image_builder=image_builder,
                      verbose=verbose,
                      gui=gui)
         vbox.stop(verbose=verbose)
-        vm.compress_disk_image()
+        vbox.compress_disk_image()
         vbox.export(output=output, verbose=verbose)
         vbox.remove(delete=True, verbose=verbose)
 
@@ -326,12 +329,16 @@ class VBoxMachine:
     This machine is supposed to be based on a casa_distro system image.
     '''
 
-    def __init__(self, name):
+    def __init__(self, name, jobs=1):
         '''
         Create an interface to a VirtualBox VM.
         name is the identifier of the VM in VirtualBox.
+        jobs is the number of concurrent file uploads used by
+        copy_root_many (each upload is a guestcontrol round-trip, so
+        copying many small files is latency-bound).
         '''
         self.name = name
+        self.jobs = jobs
         self.user = 'brainvisa'
         self.user_password = 'brainvisa'
         self.root_password = 'brainvisa'
@@ -471,7 +478,7 @@ class VBoxMachine:
                      '/bin/sh', '-c', 'umask 0022 && ' + command])
 
     def copy_root(self, source_file, dest_dir, preserve_symlinks=True,
-                  preserve_ext_symlinks=True):
+                  preserve_ext_symlinks=True, mode=None):
         '''
         Copy a file in VM as root
         '''
@@ -487,22 +494,49 @@ class VBoxMachine:
             vbox_manage(['guestcontrol', '--username', 'root',
                          '--password', self.root_password, self.name, 'copyto',
                          '--recursive', source_file, dest])
-            self.run_root('cp -r --no-preserve=mode "{tmp}/{f}" "{dest}/{f}" '
-                          '&& rm -r "{tmp}/{f}"'.format(tmp=self.tmp_dir,
-                                                        f=f,
-                                                        dest=dest_dir))
+            command = ('cp -r --no-preserve=mode "{tmp}/{f}" "{dest}/{f}" '
+                       '&& rm -r "{tmp}/{f}"'.format(tmp=self.tmp_dir,
+                                                     f=f,
+                                                     dest=dest_dir))
+            if mode is not None:
+                command += ' && chmod {mode:o} "{dest}/{f}"'.format(
+                    mode=mode, dest=dest_dir, f=f)
+            self.run_root(command)
         else:
             vbox_manage(['guestcontrol', '--username', 'root',
                          '--password', self.root_password, self.name, 'copyto',
                          '--target-directory', self.tmp_dir + os.sep,
                          source_file])
             f = os.path.basename(source_file)
-            self.run_root('cp --no-preserve=mode "{tmp}/{f}" "{dest}/{f}" '
-                          '&& rm "{tmp}/{f}"'.format(tmp=self.tmp_dir,
-                                                     f=f,
-                                                     dest=dest_dir))
+            command = ('cp --no-preserve=mode "{tmp}/{f}" "{dest}/{f}" '
+                       '&& rm "{tmp}/{f}"'.format(tmp=self.tmp_dir,
+                                                  f=f,
+                                                  dest=dest_dir))
+            if mode is not None:
+                command += ' && chmod {mode:o} "{dest}/{f}"'.format(
+                    mode=mode, dest=dest_dir, f=f)
+            self.run_root(command)
+
+    def copy_root_many(self, source_files, dest_dir, mode=None):
+        '''
+        Copy several files in VM as root
+        '''
+        # Each file goes through the temporary directory dance of
+        # copy_root, there is no faster batch path with VBoxManage, but
+        # the uploads can run concurrently to hide the per-file latency.
+        source_files = list(source_files)
+        if self.jobs > 1 and len(source_files) > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                futures = [pool.submit(self.copy_root, source_file, dest_dir,
+                                       mode=mode)
+                           for source_file in source_files]
+                for future in futures:
+                    future.result()
+        else:
+            for source_file in source_files:
+                self.copy_root(source_file, dest_dir, mode=mode)
 
-    def copy_user(self, source, dest_dir):
+    def copy_user(self, source, dest_dir, mode=None):
         '''
         Copy a file or a directory in VM as self.user
         '''
@@ -545,6 +579,9 @@ class VBoxMachine:
                         '--password', self.user_password, self.name,
                          'copyto', '--target-directory', dest_dir + os.sep,
                          source])
+        if mode is not None:
+            self.run_user('chmod {:o} "{}/{}"'.format(
+                mode, dest_dir, osp.basename(source)))
 
     def symlink(self, target, link_name):
         self.run_root('ln -s "{}" "{}"'.format(target, link_name))
@@ -591,7 +628,7 @@ class VBoxMachine:
 
         self.start_and_wait(verbose=verbose, gui=gui)
 
-        for step in image_builder.steps:
+        for step in image_builder.ordered_steps():
             if verbose:
                 print('Performing:', step.__doc__, file=verbose)
             step(base_dir=image_builder.build_dir,
@@ -637,6 +674,30 @@ def vbox_import_image(image, vbox_machine, verbose=None):
     vbox_manage(['import', image, '--vsys', '0', '--vmname', vbox_machine])
 
 
+def _copy_vdi(image, output):
+    '''
+    Copy a VDI image. A reflink clone is tried first: on btrfs/xfs it
+    completes instantly by sharing extents instead of copying the bytes
+    of a possibly huge disk image. When the filesystem does not support
+    it, fall back to VBoxManage clonemedium. After a raw file copy the
+    disk UUID must be regenerated, VirtualBox refuses to register two
+    media sharing the same UUID.
+    '''
+    try:
+        subprocess.check_call(['cp', '--reflink=always', image, output])
+    except (OSError, subprocess.CalledProcessError):
+        # a failed cp leaves an empty destination file behind, which
+        # clonemedium would refuse to overwrite
+        if osp.exists(output):
+            os.remove(output)
+        vbox_manage(['clonemedium',
+                     image, output,
+                     '--format', 'VDI',
+                     '--variant', 'Standard'])
+        return
+    vbox_manage(['internalcommands', 'sethdduuid', output])
+
+
 def vbox_import_vdi(image, vbox_machine, output,
                     verbose=None,
                     memory='8192',
@@ -649,10 +710,7 @@ def vbox_import_vdi(image, vbox_machine, output,
         os.makedirs(parent)
     if osp.exists(output):
         os.remove(output)
-    vbox_manage(['clonemedium',
-                 image, output,
-                 '--format', 'VDI',
-                 '--variant', 'Standard'])
+    _copy_vdi(image, output)
 
     if verbose:
         six.print_('Create Linux 64 bits virtual machine',
@@ -52,3 +52,24 @@ def url_listdir(url):
     parser = ListdirHTMLParser()
     parser.feed(urlopen(url).read().decode('utf8'))
     return parser.listdir[1:]
+
+
+_listdir_cache = {}
+
+
+def url_listdir_cached(url, ttl=60.):
+    '''
+    Same as url_listdir, with the result cached for ttl seconds.
+    Useful for callers that list the same server directory once per
+    image (e.g. pull_image updating several images): the remote fetch
+    and HTML parse happen once per ttl window.
+    '''
+    import time
+
+    now = time.monotonic()
+    cached = _listdir_cache.get(url)
+    if cached is not None and now - cached[0] < ttl:
+        return list(cached[1])
+    entries = url_listdir(url)
+    _listdir_cache[url] = (now, entries)
+    return list(entries)
@@ -15,22 +15,24 @@ with open(os.path.join(here, 'python', 'casa_distro', 'info.py')) as f:
     code = f.read()
     exec(code, release_info)
 
-# Parse share directory to add extra data files in a directory
+# Parse share directories to add extra data files in a directory
 # that can be automatically found during casa_distro startup
-distro_dir = os.path.join(here, 'share', 'distro')
 data_files = []
-for base, dirs, files in os.walk(distro_dir):
-    if files:
-        # data_files.extend(os.path.join(base[len(here)+1:],i) for i in files)
-        data_files.append([
-            os.path.join(
-                'lib', 'python%d.%d' % sys.version_info[:2],
-                'site-packages', 'casa_distro',
-                'share', 'distro',
-                base[len(distro_dir) + 1:]
-            ),
-            [os.path.join(base[len(here) + 1:], i) for i in files]
-        ])
+for share_subdir in ('distro', 'scripts'):
+    share_dir = os.path.join(here, 'share', share_subdir)
+    for base, dirs, files in os.walk(share_dir):
+        if files:
+            # data_files.extend(
+            #     os.path.join(base[len(here)+1:],i) for i in files)
+            data_files.append([
+                os.path.join(
+                    'lib', 'python%d.%d' % sys.version_info[:2],
+                    'site-packages', 'casa_distro',
+                    'share', share_subdir,
+                    base[len(share_dir) + 1:]
+                ),
+                [os.path.join(base[len(here) + 1:], i) for i in files]
+            ])
 # from pprint import pprint
 # pprint(data_files)
 
@@ -0,0 +1,83 @@
+#!/bin/sh
+set -xe
+umask 0022  # avoid Lintian warning non-standard-file-perm
+OS=linux
+ARCH=amd64
+DEB_HOST_MULTIARCH=x86_64-linux-gnu
+ID=
+VERSION_ID=
+. /etc/os-release  # sets the ID and VERSION_ID variables
+DISTRIB=${ID}-${VERSION_ID}
+package_version=${SINGULARITY_VERSION}~${DISTRIB}
+#Installation des packages requis
+apt-get update -y
+DEBIAN_FRONTEND=noninteractive apt-get install -y build-essential uuid-dev \
+    libgpgme-dev squashfs-tools libseccomp-dev wget pkg-config git \
+    cryptsetup-bin libssl-dev
+# Download and install GO
+rm -rf /usr/local/go
+wget -O $TMP/go${GO_VERSION}.${OS}-${ARCH}.tar.gz \
+    https://dl.google.com/go/go${GO_VERSION}.${OS}-${ARCH}.tar.gz
+tar -C /usr/local -xzf $TMP/go${GO_VERSION}.${OS}-${ARCH}.tar.gz
+rm -f $TMP/go${GO_VERSION}.${OS}-${ARCH}.tar.gz
+export GOPATH=${HOME}/go
+export GOROOT=/usr/local/go
+export PATH=$GOROOT/bin:$PATH:${GOPATH}/bin
+# Download the requested Singularity release
+wget -O $TMP/singularity-ce-${SINGULARITY_VERSION}.tar.gz \
+    https://github.com/sylabs/singularity/releases/download/v${SINGULARITY_VERSION}/singularity-ce-${SINGULARITY_VERSION}.tar.gz
+mkdir -p ${GOPATH}/src/github.com/sylabs
+tar -C ${GOPATH}/src/github.com/sylabs -zxf \
+    $TMP/singularity-ce-${SINGULARITY_VERSION}.tar.gz
+# Build and install Singularity into DESTDIR
+export DESTDIR=$TMP/singularity-ce_${package_version}_amd64
+rm -rf ${DESTDIR}
+cd ${GOPATH}/src/github.com/sylabs/singularity-ce-${SINGULARITY_VERSION}
+./mconfig \
+    -P release-stripped \
+    --prefix=/usr \
+    --sysconfdir=/etc \
+    --libexecdir=/usr/lib/${DEB_HOST_MULTIARCH} \
+    --localstatedir=/var/lib
+make -C ./builddir
+make -C ./builddir install DESTDIR=${DESTDIR}
+mkdir -p ${DESTDIR}/DEBIAN
+cat <<EOF > ${DESTDIR}/DEBIAN/control
+Package: singularity-ce
+Version: ${package_version}
+Maintainer: BrainVISA release team <admin@brainvisa.info>
+Architecture: ${ARCH}
+Section: admin
+Priority: optional
+Depends: squashfs-tools, ca-certificates, cryptsetup-bin, libc6, libseccomp2
+Conflicts: singularity-container
+Replaces: singularity-container (<< ${SINGULARITY_VERSION})
+Recommends: e2fsprogs
+Homepage: https://www.sylabs.io/
+Description: container platform focused on supporting "Mobility of Compute"
+ Mobility of Compute encapsulates the development to compute model
+ where developers can work in an environment of their choosing and
+ creation and when the developer needs additional compute resources,
+ this environment can easily be copied and executed on other platforms.
+ Additionally as the primary use case for Singularity is targeted
+ towards computational portability, many of the barriers to entry of
+ other container solutions do not apply to Singularity making it an
+ ideal solution for users (both computational and non-computational)
+ and HPC centers.
+EOF
+# Fix Lintian warning setuid-binary
+mkdir -p ${DESTDIR}/usr/share/lintian/overrides
+cat <<EOF > ${DESTDIR}/usr/share/lintian/overrides/singularity-ce
+# Singularity requires root suid for operation:
+setuid-binary usr/lib/*/singularity/bin/*-suid 4755 root/root
+EOF
+# Fix Lintian warning package-installs-into-obsolete-dir
+mkdir -p ${DESTDIR}/usr/share/bash-completion/completions
+mv ${DESTDIR}/etc/bash_completion.d/* \
+    ${DESTDIR}/usr/share/bash-completion/completions/
+rmdir ${DESTDIR}/etc/bash_completion.d/
+# Fix Lintian warning file-in-etc-not-marked-as-conffile
+find ${DESTDIR}/etc ! -type d -print \
+    | sed -e "s!^${DESTDIR%/}!!" \
+    > ${DESTDIR}/DEBIAN/conffiles
+dpkg-deb --build ${DESTDIR} "$TMP"